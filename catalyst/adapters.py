@@ -2,23 +2,47 @@ from sqlalchemy.ext.baked import BakedQuery
 
 __author__ = 'kamyar'
 
-from sqlalchemy import func, or_, and_, not_, inspect, Column, bindparam
-from sqlalchemy.orm import Query, RelationshipProperty, contains_eager, aliased, load_only, Session, ColumnProperty
+from sqlalchemy import func, or_, and_, not_, inspect, Column, bindparam, event, tuple_, text, distinct, \
+    literal_column, cast, any_, all_, ARRAY, Text, Boolean
+from sqlalchemy.dialects.postgresql import JSONB
+from geoalchemy2 import Geography
+from sqlalchemy.orm import Query, RelationshipProperty, contains_eager, aliased, load_only, Session, ColumnProperty, \
+    Mapper, selectinload
 from sqlalchemy.ext import baked
 from abc import abstractmethod
+from enum import IntFlag
 import re
 import pyparsing as pp
+import rapidjson
 from urllib.parse import parse_qs, unquote_plus
 import functools
-from datetime import datetime, time
+import threading
+from datetime import datetime, date, time
+from decimal import Decimal
+from uuid import UUID
+import base64
 import operator
 import collections
-from typing import Callable, Tuple, Optional, Dict, List, Any, NamedTuple, Union, TypeVar
-from logging import Logger
+from typing import Callable, Tuple, Optional, Dict, List, Any, NamedTuple, Union, Iterator
+from logging import Logger, DEBUG
+from contextlib import contextmanager
+from time import perf_counter
 
 from sqlalchemy.orm.attributes import InstrumentedAttribute
-from sqlalchemy.sql.elements import ColumnElement, BinaryExpression
-from sqlalchemy.sql import Alias
+from sqlalchemy.orm.util import AliasedClass
+from sqlalchemy.engine import Row
+from sqlalchemy.sql.elements import ColumnElement, BinaryExpression, BindParameter
+from sqlalchemy.sql.traversals import InternalTraversal
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql import Alias, visitors, operators
+from sqlalchemy.sql.sqltypes import NullType
+from http import HTTPStatus
+
+from catalyst.constants import FILTER_CACHE_SIZE, STATEMENT_CACHE_SIZE, QUERY_METRICS_SIZE, STREAM_CHUNK_SIZE, \
+    TEXT_SEARCH_CONFIG, ErrorMessages, SRID
+from catalyst.errors import ApiError
+from catalyst.filter_parser import FilterParser, ParsingException
+from catalyst.types import location_from_string
 
 bakery = baked.bakery()
 
@@ -33,9 +57,26 @@ class PartConstants:
     Skip = '$skip'
     Select = '$select'
     Expand = '$expand'
+    SkipToken = '$skiptoken'
+    DeltaToken = '$deltatoken'
+    Count = '$count'
+    Apply = '$apply'
+    Search = '$search'
 
 
-class ParsingException(Exception):
+class CountPolicy(IntFlag):
+    """
+    How the total count of OData results is obtained. Flags may be combined.
+    """
+    Exact = 0
+    OnRequest = 1  # Count only if $count=true is requested
+    Estimate = 2  # Use the database planner estimate if it is above the threshold
+
+
+class EstimatedCount(int):
+    """
+    Row count estimated by the database planner, rather than counted
+    """
     pass
 
 
@@ -58,7 +99,1139 @@ def get_type(expr):
     raise TypeError("Couldn't inspect type.")
 
 
-Entity = TypeVar('Entity')
+def date_part_func(part: str):
+    def date_part_reverse(part_rev: str, val):
+        return func.date_part(val, part_rev)
+
+    return functools.partial(date_part_reverse, part)
+
+
+def as_array(a, values: ColumnElement, item_type: Any = None) -> ColumnElement:
+    """
+    Casts the list parameter to an array of the column (item) type, so that the list is sent as one array
+    parameter whatever its length, and string values of the filter are converted by database
+    :param a: Column the values are compared with
+    :param values: Bound parameter holding list of values
+    :param item_type: Type of the array items, type of the column by default
+    :return: SqlAlchemy array expression
+    """
+    item_type = item_type or a.type
+    return values if isinstance(item_type, NullType) else cast(values, ARRAY(item_type))
+
+
+class ListMembership(ColumnElement):
+    """
+    Whether the expression is (or is not) one of the values of the list parameter. On PostgreSQL the list is sent as
+    one array parameter, on other databases it is expanded into IN parameters.
+    """
+    __visit_name__ = 'list_membership'
+    inherit_cache = True
+    type = Boolean()
+    _traverse_internals = [('column', InternalTraversal.dp_clauseelement),
+                           ('values', InternalTraversal.dp_clauseelement),
+                           ('negated', InternalTraversal.dp_boolean)]
+
+    def __init__(self, column: ColumnElement, values: BindParameter, negated: bool = False):
+        self.column = column
+        self.values = values
+        self.negated = negated
+
+    @property
+    def _from_objects(self):
+        return self.column._from_objects
+
+
+@compiles(ListMembership)
+def compile_list_membership(element: ListMembership, compiler, **kw):
+    values = element.values._clone()
+    values.expanding = True
+    return compiler.process(element.column.not_in(values) if element.negated else element.column.in_(values), **kw)
+
+
+@compiles(ListMembership, 'postgresql')
+def compile_postgresql_list_membership(element: ListMembership, compiler, **kw):
+    values = as_array(element.column, element.values)
+    return compiler.process(element.column != all_(values) if element.negated else element.column == any_(values),
+                            **kw)
+
+
+def containing(a, b: ColumnElement):
+    return ListMembership(a, b)
+
+
+def excluding(a, b: ColumnElement):
+    return ListMembership(a, b, negated=True)
+
+
+def array_has(a, b: ColumnElement):
+    """
+    Whether the array or JSONB column has all the values, using @> and ?& operators which GIN indexes support
+    """
+    if isinstance(a.type, ARRAY):
+        return a.op('@>', is_comparison=True)(cast(b, a.type))
+    elif isinstance(a.type, JSONB):
+        return a.has_all(as_array(a, b, Text()))
+    raise ParsingException(f'Operator has is not supported for {a}')
+
+
+def array_lacks(a, b: ColumnElement):
+    """
+    Whether the array or JSONB column has none of the values, negating the && and ?| operators
+    """
+    if isinstance(a.type, ARRAY):
+        return not_(a.op('&&', is_comparison=True)(cast(b, a.type)))
+    elif isinstance(a.type, JSONB):
+        return not_(a.has_any(as_array(a, b, Text())))
+    raise ParsingException(f'Operator lacks is not supported for {a}')
+
+
+text_search_config = literal_column(f"'{TEXT_SEARCH_CONFIG}'::regconfig")
+search_rank_field = '$rank'
+
+
+def text_search(vector: ColumnElement, terms: Any) -> ColumnElement:
+    """
+    Full-text search predicate, tsvector @@ tsquery, which can use GIN index of the vector expression
+    :param vector: tsvector column or expression
+    :param terms: Search terms in web search syntax (quoted phrases, or, -excluded)
+    :return: SqlAlchemy boolean expression
+    """
+    return vector.op('@@', is_comparison=True)(func.websearch_to_tsquery(text_search_config, terms))
+
+
+point_pattern = re.compile(r'^\s*-?[\d.]+\s*,\s*-?[\d.]+\s*$')
+geo_distance_pattern = re.compile(r"^geo\.distance\(\s*(?P<field>[\w.]+)\s*,\s*'(?P<value>[^']+)'\s*\)$", re.I)
+
+
+def geometry_literal(value: Any) -> ColumnElement:
+    """
+    Converts OData geometry literal into PostGIS geometry: 'lat,lon' points (as like catalyst.types.Location) or WKT
+    :param value: Literal value
+    :return: SqlAlchemy geometry expression with the default SRID
+    """
+    if isinstance(value, str) and point_pattern.match(value):
+        location = location_from_string(value)
+        return func.ST_SetSRID(func.ST_MakePoint(location.lon, location.lat), SRID)
+    return func.ST_GeomFromText(value, SRID)
+
+
+def as_geography(expr: ColumnElement) -> ColumnElement:
+    """
+    Geography of the expression, so distances are measured in meters. Geometry columns need a GiST index on the
+    (column::geography) expression for the distance predicates to use index.
+    """
+    return expr if isinstance(getattr(expr, 'type', None), Geography) else cast(expr, Geography(srid=SRID))
+
+
+op_map = {
+    'eq': operator.eq,
+    'ne': operator.ne,
+    'gt': operator.gt,
+    'lt': operator.lt,
+    'ge': operator.ge,
+    'le': operator.le,
+    'add': operator.add,
+    'sub': operator.sub,
+    'mul': operator.mul,
+    'div': operator.truediv,
+    'mod': operator.mod,
+    'AND': and_,
+    'OR': or_,
+    'in': containing,
+    'out': excluding,
+    'has': array_has,
+    'lacks': array_lacks
+}
+
+func_map = {'substringof': lambda a, b: b.ilike('%{0}%'.format(a)),
+            'endswith': lambda a, b: a.ilike('%{0}'.format(b)),
+            'startswith': lambda a, b: a.ilike('{0}%'.format(b)),
+            'length': func.length,
+            'indexof': func.position,
+            'replace': func.replace,
+            'substring': func.substring,
+            'tolower': func.lower,
+            'toupper': func.upper,
+            'trim': func.trim,
+            'round': func.round,
+            'floor': func.floor,
+            'ceiling': func.ceiling,
+            'year': date_part_func('year'),
+            'month': date_part_func('month'),
+            'day': date_part_func('day'),
+            'hour': date_part_func('hour'),
+            'minute': date_part_func('minute'),
+            'second': date_part_func('second'),
+            'search': lambda a, b: text_search(func.to_tsvector(text_search_config, a), b),
+            'similar': lambda a, b: a.op('%', is_comparison=True)(b),
+            'geo.distance': lambda a, b: func.ST_Distance(as_geography(a), as_geography(geometry_literal(b))),
+            'geo.dwithin': lambda a, b, c: func.ST_DWithin(as_geography(a), as_geography(geometry_literal(b)), c),
+            'geo.intersects': lambda a, b: func.ST_Intersects(a, geometry_literal(b)),
+            'geo.within': lambda a, b: func.ST_Within(a, geometry_literal(b)),
+            }
+
+aggregate_map = {'sum': func.sum,
+                 'min': func.min,
+                 'max': func.max,
+                 'average': func.avg,
+                 'countdistinct': lambda c: func.count(distinct(c)),
+                 }
+
+
+# region Parser Configuration
+
+def create_filter_grammar() -> pp.ParserElement:
+    """
+    Builds the pyparsing grammar of OData $filter expressions. It is built once per process and shared by all adapters.
+    :return: pyparsing parser element
+    """
+    operator_ = pp.Regex('|'.join(op_map.keys())).setName('operator')
+    number = pp.Regex(r'[\d\.]+')
+    identifier = pp.Regex(r'[a-z][\w\.]*')
+    str_value = pp.QuotedString("'", unquoteResults=False, escChar='\\')
+    date_value = pp.Regex(r'\d{4}-\d{1,2}-\d{1,2}')
+    collection_value = pp.Suppress('[') + pp.delimitedList(pp.Regex(r'[\w_]+'), combine=True) + pp.Suppress(']')
+    l_par = pp.Suppress('(')
+    r_par = pp.Suppress(')')
+    function_call = pp.Forward()
+    arg = function_call | identifier | date_value | number | collection_value | str_value
+    function_call = pp.Group(identifier + l_par + pp.Optional(pp.delimitedList(arg)) + r_par)
+    param = function_call | arg
+    condition = pp.Group(param + operator_ + param)
+
+    return pp.operatorPrecedence(condition, [
+        (pp.CaselessLiteral("AND"), 2, pp.opAssoc.LEFT,),
+        (pp.CaselessLiteral("OR"), 2, pp.opAssoc.LEFT,),
+    ])
+
+
+filter_grammar = create_filter_grammar()
+fast_filter_parser = FilterParser(op_map.keys())
+
+# endregion
+
+
+def freeze_parse_result(e: Union[str, List]) -> Union[str, Tuple]:
+    return e if isinstance(e, str) else tuple(map(freeze_parse_result, e))
+
+
+@functools.lru_cache(maxsize=FILTER_CACHE_SIZE)
+def parse_filter_string(filter_string: str, use_fast_parser: bool = False) -> Tuple:
+    """
+    Parses raw OData $filter text into an entity-independent AST (nested tuples of tokens). Results are kept in a
+    bounded LRU cache, so repeated filters skip the parser entirely.
+    :param filter_string: Raw $filter value
+    :param use_fast_parser: Use the hand-written precedence-climbing parser instead of pyparsing
+    :return: Nested tuples as consumed by ODataQueryAdapter.parse_filter
+    """
+    if use_fast_parser:
+        return fast_filter_parser.parse(filter_string)
+    return freeze_parse_result(filter_grammar.parseString(filter_string).asList())
+
+
+def get_filter_cache_info():
+    """
+    Hit/miss counters of the parsed filter cache
+    :return: Named tuple of hits, misses, maxsize and currsize
+    """
+    return parse_filter_string.cache_info()
+
+
+IDENTIFIER = object()
+comparison_operators = frozenset(('eq', 'ne', 'gt', 'lt', 'ge', 'le'))
+collection_operators = frozenset(('in', 'out', 'has', 'lacks'))
+
+
+def parse_literal(s: str) -> Any:
+    """
+    Converts literal token of the filter AST into Python value
+    :param s: Filter AST token
+    :return: Python value, or IDENTIFIER if the token is not a literal
+    """
+    if re.match(r"^'?\d{2,4}-\d{1,2}-\d{1,2}'?$", s):
+        return datetime.strptime(s.strip("'"), '%Y-%m-%d')
+    elif re.match(r"^'?\d{1,2}:\d{1,2}(:\d{1,2})?'?", s):
+        return time.fromisoformat(s.strip("'"))
+    elif re.match(r'^\d+$', s):
+        return int(s.strip("'"))
+    elif re.match(r'^[\d.]+$', s):
+        return float(s.strip("'"))
+    elif re.match(r"^'.+'$", s) or ',' in s:
+        return s.strip("'")
+    elif s == 'true':
+        return True
+    elif s == 'false':
+        return False
+    elif s == 'null':
+        return
+    return IDENTIFIER
+
+
+def parse_collection(s: str) -> List[str]:
+    """
+    Converts right operand of collection operators, as like [a,b,c] (tokenized as 'a,b,c') or 'a', into list of values
+    :param s: Filter AST token
+    :return: List of values
+    """
+    if re.match(r"^'.*'$", s):
+        return [s[1:-1]]
+    return [item.strip() for item in s.split(',')]
+
+
+class FilterParameter(NamedTuple):
+    index: int
+    kind: str
+
+
+def lift_literals(node: Union[str, Tuple], values: List[Any]) -> Union[str, Tuple]:
+    """
+    Replaces literal operands of comparisons in the filter AST with FilterParameter placeholders, so that filters
+    differing only in those values share the same shape. Nulls, booleans and function arguments stay in place, since
+    they change the generated SQL. Values of collection operators are lifted as one list, whatever its length.
+    :param node: Filter AST
+    :param values: List collecting the lifted values, indexed by the placeholders
+    :return: Filter AST with placeholders
+    """
+    if isinstance(node, (str, PrefixMatch)):
+        return node
+
+    if len(node) == 3 and isinstance(node[1], str) and node[1] in comparison_operators:
+
+        def lift(operand: Union[str, Tuple]) -> Union[str, Tuple]:
+            if isinstance(operand, str):
+                value = parse_literal(operand)
+                if value is not IDENTIFIER and value is not None and not isinstance(value, bool):
+                    values.append(value)
+                    return FilterParameter(index=len(values) - 1, kind=type(value).__name__)
+            return lift_literals(operand, values)
+
+        return lift(node[0]), node[1], lift(node[2])
+
+    if len(node) == 3 and isinstance(node[1], str) and node[1] in collection_operators and isinstance(node[2], str):
+        values.append(parse_collection(node[2]))
+        return lift_literals(node[0], values), node[1], FilterParameter(index=len(values) - 1, kind='list')
+
+    return tuple(lift_literals(item, values) for item in node)
+
+
+def format_filter_shape(node: Union[str, Tuple]) -> str:
+    """
+    Renders filter AST back into OData-like text, placing ? for the literals (other than null and booleans) and
+    parameters, so that filters differing only in values are rendered the same
+    :param node: Filter AST
+    :return: Filter text
+    """
+    if isinstance(node, FilterParameter):
+        return '?'
+    elif isinstance(node, PrefixMatch):
+        return f'startswith({format_filter_shape(node.column)}, ?)'
+    elif isinstance(node, str):
+        value = parse_literal(node)
+        return node if value is IDENTIFIER or value is None or isinstance(value, bool) else '?'
+    elif len(node) == 1:
+        return format_filter_shape(node[0])
+    elif isinstance(node[0], str) and node[0].lower() in func_map:
+        return f"{node[0]}({', '.join(map(format_filter_shape, node[1:]))})"
+    return f"({' '.join(map(format_filter_shape, node))})"
+
+
+# region Sargable Rewrite
+
+class PrefixMatch(NamedTuple):
+    """
+    Case-sensitive LIKE 'prefix%' predicate, which may use text_pattern_ops (or C collation) b-tree indexes
+    """
+    column: Union[str, Tuple]
+    pattern: str
+
+
+mirrored_operators = {'eq': 'eq', 'ne': 'ne', 'gt': 'lt', 'lt': 'gt', 'ge': 'le', 'le': 'ge'}
+
+
+def rewrite_year_comparison(column: Union[str, Tuple], op: str, year: int) -> Optional[Tuple]:
+    """
+    Rewrites year(column) comparison into half-open range of the column itself
+    :param column: Compared column node
+    :param op: Comparison operator
+    :param year: Compared year
+    :return: Equivalent filter AST, or None if not applicable
+    """
+    if not 0 < year < 9999:
+        return None
+    start, end = f'{year:04d}-01-01', f'{year + 1:04d}-01-01'
+    return {'eq': ((column, 'ge', start), 'AND', (column, 'lt', end)),
+            'ne': ((column, 'lt', start), 'OR', (column, 'ge', end)),
+            'gt': (column, 'ge', end),
+            'ge': (column, 'ge', start),
+            'lt': (column, 'lt', start),
+            'le': (column, 'lt', end)}[op]
+
+
+def rewrite_prefix_match(column: Union[str, Tuple], value: str) -> Optional[PrefixMatch]:
+    """
+    Rewrites startswith(column, 'value') (which is a case-insensitive ILIKE) into case-sensitive LIKE, if the value
+    makes no difference between the two: it has no cased letters, or the column is lowered/uppered accordingly (which
+    only the fast parser accepts, as the grammar rejects nested calls)
+    :param column: Column node, may be a tolower/toupper call
+    :param value: Quoted prefix token
+    :return: Prefix predicate, or None if not applicable
+    """
+    if not (len(value) > 2 and value.startswith("'") and value.endswith("'")):
+        return None
+    value = value[1:-1]
+    if '\\' in value:
+        return None
+
+    function = column[0].lower() if isinstance(column, tuple) and len(column) == 2 else None
+    if not (function == 'tolower' and value == value.lower() or
+            function == 'toupper' and value == value.upper() or
+            value.lower() == value.upper()):
+        return None
+    return PrefixMatch(column=column, pattern=value.replace('%', '\\%').replace('_', '\\_') + '%')
+
+
+def rewrite_distance_comparison(distance: Tuple, op: str, value: str) -> Optional[Tuple]:
+    """
+    Rewrites geo.distance(column, point) lt/le d into ST_DWithin, which can use spatial index. Strict comparison keeps
+    the distance check as well, to exclude the exact boundary.
+    :param distance: geo.distance function node
+    :param op: Comparison operator
+    :param value: Compared distance token
+    :return: Equivalent filter AST, or None if not applicable
+    """
+    if not re.match(r'^[\d.]+$', value):
+        return None
+    within = (('geo.dwithin',) + distance[1:] + (value,), 'eq', 'true')
+    return within if op == 'le' else (within, 'AND', (distance, op, value))
+
+
+@functools.lru_cache(maxsize=FILTER_CACHE_SIZE)
+def rewrite_sargable(node: Union[str, Tuple]) -> Union[str, Tuple]:
+    """
+    Rewrites predicates of the filter AST which wrap columns into functions, so that they can use b-tree indexes of the
+    columns: year(created_at) eq 2021 into a half-open timestamp range, startswith into a LIKE prefix match and
+    geo.distance comparison into ST_DWithin. Predicates which can not be rewritten keep the original translation.
+    :param node: Filter AST
+    :return: Rewritten filter AST
+    """
+    if isinstance(node, str):
+        return node
+
+    if len(node) == 3 and isinstance(node[1], str) and node[1] in comparison_operators:
+        left, op, right = node
+        if isinstance(right, tuple) and isinstance(left, str):
+            left, op, right = right, mirrored_operators[op], left
+
+        if isinstance(left, tuple) and len(left) == 2 and isinstance(left[0], str) and isinstance(right, str):
+            function = left[0].lower()
+            if function == 'year' and re.match(r'^\d{1,4}$', right):
+                result = rewrite_year_comparison(left[1], op, int(right))
+                if result:
+                    return result
+
+        if isinstance(left, tuple) and len(left) == 3 and isinstance(left[0], str) and \
+                left[0].lower() == 'geo.distance' and isinstance(right, str) and op in ('lt', 'le'):
+            result = rewrite_distance_comparison(left, op, right)
+            if result:
+                return result
+
+        if isinstance(left, tuple) and len(left) == 3 and isinstance(left[0], str) and \
+                left[0].lower() == 'startswith' and isinstance(left[2], str) and \
+                (op, right) in (('eq', 'true'), ('ne', 'false')):
+            result = rewrite_prefix_match(left[1], left[2])
+            if result:
+                return result
+
+        return node
+
+    return tuple(rewrite_sargable(item) for item in node)
+
+
+# endregion
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0
+
+
+class StatementCache:
+    """
+    Bounded LRU cache of query building results, keyed by the shape of OData requests
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.items: collections.OrderedDict = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple) -> Any:
+        with self.lock:
+            result = self.items.get(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.items.move_to_end(key)
+            return result
+
+    def put(self, key: Tuple, value: Any):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.hits = self.misses = 0
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(hits=self.hits, misses=self.misses, maxsize=self.maxsize, currsize=len(self.items))
+
+
+statement_cache = StatementCache(STATEMENT_CACHE_SIZE)
+
+
+def get_statement_cache_info() -> CacheInfo:
+    """
+    Hit/miss counters of the shape-keyed statement cache
+    :return: Named tuple of hits, misses, maxsize, currsize and hit_rate
+    """
+    return statement_cache.info()
+
+
+# region Query Metrics
+
+class QueryShapeStats(NamedTuple):
+    """
+    Accumulated metrics of the requests of one shape. Times are total seconds, so they can be scraped as counters.
+    """
+    calls: int = 0
+    rows: int = 0
+    parse_time: float = 0.0
+    build_time: float = 0.0
+    execution_time: float = 0.0
+    count_time: float = 0.0
+    max_execution_time: float = 0.0
+
+
+class QueryMetrics:
+    """
+    In-process registry of query timings, keyed by the normalized shape of OData requests (literals replaced by ?).
+    Only the recently used maxsize shapes are kept.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.items: collections.OrderedDict = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def record(self, shape: str, timings: Dict[str, float], rows: int = 0):
+        """
+        Adds timings of a request to the stats of its shape
+        :param shape: Normalized request shape, see QueryAdapter.get_shape_description
+        :param timings: Seconds spent in each phase, keyed by QueryShapeStats field names
+        :param rows: Number of the returned rows
+        """
+        with self.lock:
+            stats = self.items.get(shape) or QueryShapeStats()
+            self.items[shape] = stats._replace(
+                calls=stats.calls + 1,
+                rows=stats.rows + rows,
+                max_execution_time=max(stats.max_execution_time, timings.get('execution_time', 0.0)),
+                **{k: getattr(stats, k) + v for k, v in timings.items()})
+            self.items.move_to_end(shape)
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def snapshot(self) -> Dict[str, QueryShapeStats]:
+        with self.lock:
+            return dict(self.items)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+query_metrics = QueryMetrics(QUERY_METRICS_SIZE)
+
+
+def get_query_metrics() -> Dict[str, Dict[str, Any]]:
+    """
+    Timing metrics of the OData requests per normalized shape, as like
+    {'Order?$filter=(price gt ?)&$orderby=id asc': {'calls': 12, 'rows': 120, 'execution_time': 0.31, ...}}
+    :return: Dictionary of the stats of each shape
+    """
+    return {shape: stats._asdict() for shape, stats in query_metrics.snapshot().items()}
+
+
+# endregion
+
+
+class CachedQuery(NamedTuple):
+    query: Query
+    filter: Tuple[ColumnElement, ...]
+    join: Tuple[str, ...]
+    aliases: Dict[str, AliasedClass]
+    fields: Tuple[Any, ...]
+    projection: Optional['Projection']
+
+
+# region Projection
+
+class Projection:
+    """
+    Converts rows of a column-only query into nested dictionaries, as like {'id': 1, 'city': {'name': 'Tehran'}},
+    without instantiating ORM entities. Expanded entities whose columns are all null (not found by the outer join)
+    become None.
+    """
+
+    def __init__(self, labels: Tuple[str, ...]):
+        self.labels = labels
+        self.paths: Tuple[Tuple[str, ...], ...] = tuple(tuple(label.split('.')) for label in labels)
+        prefixes = {path[:i] for path in self.paths for i in range(1, len(path))}
+        self.prefixes: Tuple[Tuple[str, ...], ...] = tuple(sorted(prefixes, key=len, reverse=True))
+
+    def __call__(self, row: Row) -> Dict[str, Any]:
+        result = {}
+        for path, value in zip(self.paths, row):
+            target = result
+            for name in path[:-1]:
+                target = target.setdefault(name, {})
+            target[path[-1]] = value
+
+        for prefix in self.prefixes:
+            parent = functools.reduce(lambda d, name: d and d[name], prefix[:-1], result)
+            if parent and not any(v is not None for v in parent[prefix[-1]].values()):
+                parent[prefix[-1]] = None
+
+        return result
+
+
+# endregion
+
+# region Aggregation
+
+class Aggregation(NamedTuple):
+    group_by: Tuple[ColumnElement, ...]
+    columns: Tuple[ColumnElement, ...]
+    shape: Tuple[str, ...]
+
+
+def split_top_level(text: str, separator: str) -> List[str]:
+    """
+    Splits text by the separator, except inside parentheses and quoted strings
+    :param text: Text to split
+    :param separator: Single character separator
+    :return: Parts of the text
+    """
+    parts = []
+    depth = 0
+    quoted = False
+    start = 0
+    for index, char in enumerate(text):
+        if char == "'":
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == separator and depth == 0:
+            parts.append(text[start:index])
+            start = index + 1
+    parts.append(text[start:])
+    return parts
+
+
+# endregion
+
+# region Complexity Analysis
+
+class QueryComplexity(NamedTuple):
+    joins: int
+    depth: int
+    wildcard_searches: int
+    unindexed_sorts: int
+    score: int
+    cost: Optional[float] = None
+
+
+complexity_weights = {
+    'joins': 5,
+    'depth': 10,
+    'wildcard_searches': 25,
+    'unindexed_sorts': 15,
+}
+
+
+def count_wildcard_searches(expression: ColumnElement) -> int:
+    """
+    Counts LIKE/ILIKE comparisons with leading wildcard (as like substringof and endswith), which can not use b-tree
+    indexes and scan the whole table
+    :param expression: SqlAlchemy filter expression
+    :return: Number of such comparisons
+    """
+    return sum(1 for e in visitors.iterate(expression)
+               if isinstance(e, BinaryExpression)
+               and e.operator in (operators.like_op, operators.ilike_op)
+               and isinstance(getattr(e.right, 'value', None), str)
+               and e.right.value.startswith('%'))
+
+
+def is_indexed(column: Any) -> bool:
+    """
+    Whether the column is primary key, unique or the leading column of an index
+    :param column: Entity attribute or table column
+    :return: True if indexed, False if not or the column is not a table column (as like labels)
+    """
+    if isinstance(getattr(column, 'property', None), ColumnProperty):
+        column = column.property.columns[0]
+    if not isinstance(column, Column) or column.table is None:
+        return False
+    return bool(column.primary_key or column.index or column.unique or
+                any(next(iter(index.columns), None) is column for index in column.table.indexes))
+
+
+def explain_plan(connection, query: Query, analyze: bool = False) -> Dict[str, Any]:
+    """
+    Runs PostgreSQL EXPLAIN of the query, without running the query itself unless analyze is set
+    :param connection: SqlAlchemy connection
+    :param query: Query to explain
+    :param analyze: Runs EXPLAIN (ANALYZE, BUFFERS), so the plan includes actual times, rows and buffer usage
+    :return: The root plan node, including 'Plan Rows' and 'Total Cost'
+    """
+    compiled = query.statement.compile(dialect=connection.dialect, compile_kwargs={'render_postcompile': True})
+    params = tuple(compiled.params[k] for k in compiled.positiontup) if compiled.positional else compiled.params
+    options = 'ANALYZE, BUFFERS, FORMAT JSON' if analyze else 'FORMAT JSON'
+    plan = connection.exec_driver_sql(f'EXPLAIN ({options}) {compiled}', params).scalar()
+    if isinstance(plan, str):
+        plan = rapidjson.loads(plan)
+    return plan[0]['Plan']
+
+
+# endregion
+
+# region Index Advisor
+
+trigram_functions = frozenset(('substringof', 'endswith', 'startswith', 'similar'))
+expression_functions = {'tolower': func.lower, 'toupper': func.upper}
+range_operators = frozenset(('eq', 'ne', 'gt', 'lt', 'ge', 'le', 'in', 'out'))
+equality_operators = frozenset(('eq', 'in'))
+
+
+def collect_filter_usage(node: Union[str, Tuple]) -> Iterator[Tuple[str, str]]:
+    """
+    Finds the properties used in filter AST, along with how they are used: the comparison operator, or the function
+    applied to them (as like substringof)
+    :param node: Filter AST
+    :return: Pairs of property path (as like city.name) and operator or function name
+    """
+    if isinstance(node, PrefixMatch):
+        yield from ((path, 'prefix') for path, _ in collect_filter_usage(node.column))
+    elif isinstance(node, (str, FilterParameter)):
+        if isinstance(node, str) and parse_literal(node) is IDENTIFIER and not re.match(r'^[A-Z_]+$', node):
+            yield node, 'eq'
+    elif len(node) == 1:
+        yield from collect_filter_usage(node[0])
+    elif isinstance(node[0], str) and node[0].lower() in func_map:
+        for argument in node[1:]:
+            yield from ((path, node[0].lower()) for path, _ in collect_filter_usage(argument))
+    elif len(node) == 3 and node[1] in op_map and node[1] not in ('AND', 'OR'):
+        for operand in (node[0], node[2]):
+            yield from ((path, node[1] if usage == 'eq' else usage) for path, usage in collect_filter_usage(operand))
+    else:
+        for item in node[::2]:
+            yield from collect_filter_usage(item)
+
+
+class FieldUsage(NamedTuple):
+    calls: int = 0
+    time: float = 0.0
+
+
+class UsageStatistics:
+    """
+    In-process statistics of the properties used by clients in $filter and $orderby, weighted by the execution time
+    of the queries, which suggest_indexes cross-references with the indexes of the models
+    """
+
+    def __init__(self):
+        self.filters: Dict[Tuple[type, str, str], FieldUsage] = {}
+        self.sorts: Dict[Tuple[type, str], FieldUsage] = {}
+        self.combinations: Dict[Tuple[type, Tuple[str, ...], Tuple[str, ...]], FieldUsage] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def add(items: Dict[Tuple, FieldUsage], key: Tuple, duration: float):
+        usage = items.get(key) or FieldUsage()
+        items[key] = FieldUsage(calls=usage.calls + 1, time=usage.time + duration)
+
+    def record(self, adapter: 'QueryAdapter', duration: float):
+        """
+        Adds the usage of a parsed request
+        :param adapter: Adapter which has parsed the request
+        :param duration: Execution time of the request query in seconds
+        """
+        filters = {usage for tree in adapter.filter_shape for usage in collect_filter_usage(tree)}
+        sorts = tuple(field for field, _ in adapter.order_by)
+        equalities = tuple(sorted({path for path, op in filters if op in equality_operators and '.' not in path}))
+        with self.lock:
+            for path, op in filters:
+                self.add(self.filters, (adapter.cls, path, op), duration)
+            for field in sorts:
+                self.add(self.sorts, (adapter.cls, field), duration)
+            if equalities and sorts and not any('.' in f or '(' in f for f in sorts):
+                self.add(self.combinations, (adapter.cls, equalities, sorts), duration)
+
+    def clear(self):
+        with self.lock:
+            self.filters.clear()
+            self.sorts.clear()
+            self.combinations.clear()
+
+
+usage_statistics = UsageStatistics()
+
+opclass_name_suffixes = {'gin_trgm_ops': 'trgm', 'gist_trgm_ops': 'gist_trgm',
+                         'text_pattern_ops': 'pattern', 'varchar_pattern_ops': 'pattern'}
+
+
+class IndexSuggestion(NamedTuple):
+    table: str
+    columns: Tuple[str, ...]
+    method: str
+    opclass: Optional[str]
+    calls: int
+    time: float
+    reason: str
+
+    @property
+    def ddl(self) -> str:
+        if self.opclass:
+            suffix = (opclass_name_suffixes.get(self.opclass) or re.sub(r'_ops$', '', self.opclass),)
+        else:
+            suffix = () if self.method == 'btree' else (self.method,)
+        name = re.sub(r'\W+', '_', '_'.join(('ix', self.table) + self.columns + suffix)).strip('_')
+        columns = ', '.join(f'{c} {self.opclass}' if self.opclass else c for c in self.columns)
+        return f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {self.table} USING {self.method} ({columns});'
+
+
+def has_index(table: Any, columns: Tuple[Any, ...], method: str = 'btree', opclass: Optional[str] = None) -> bool:
+    """
+    Whether any index of the table starts with the given columns (or expressions), using the index method and
+    operator class
+    :param table: SqlAlchemy table
+    :param columns: Table columns or expressions over them
+    :param method: Index method, as like btree, gin or gist
+    :param opclass: Operator class of the columns, as like gin_trgm_ops
+    """
+    names = tuple(str(c) for c in columns)
+    if method == 'btree' and opclass is None and len(columns) == 1 and isinstance(columns[0], Column):
+        if is_indexed(columns[0]):
+            return True
+    for index in table.indexes:
+        options = index.dialect_options['postgresql']
+        if (options['using'] or 'btree').lower() != method:
+            continue
+        if tuple(str(e) for e in index.expressions[:len(columns)]) != names:
+            continue
+        if opclass is None or all((options['ops'] or {}).get(getattr(c, 'name', None)) == opclass for c in columns):
+            return True
+    return False
+
+
+def suggest_indexes(min_calls: int = 1) -> List[IndexSuggestion]:
+    """
+    Suggests indexes for the properties which clients filter and sort by, missing from the model tables: b-tree for
+    comparisons and sorting, trigram GIN for substring searches, GIN for has/lacks, GiST for geo functions,
+    expression indexes for tolower/toupper, and composite b-tree for equality filters commonly sorted by another column
+    :param min_calls: Ignores usages seen in fewer requests
+    :return: Suggestions, the most time consuming first
+    """
+    suggestions: Dict[Tuple, IndexSuggestion] = {}
+
+    def resolve(cls: type, path: str) -> Optional[Column]:
+        if '.' in path:
+            relationship, name = path.rsplit('.', 1)
+            try:
+                cls = get_entity_metadata(cls).entity_at(relationship.replace('.', '/'))
+            except AttributeError:
+                return None
+        else:
+            name = path
+        column = getattr(getattr(cls, '__table__', None), 'c', {}).get(name)
+        return column if isinstance(column, Column) else None
+
+    def suggest(columns: Tuple[Any, ...], method: str, opclass: Optional[str], usage: FieldUsage, reason: str):
+        table = next(c for c in visitors.iterate(columns[0]) if isinstance(c, Column)).table
+        if has_index(table, columns, method, opclass):
+            return
+        names = tuple(c.name if isinstance(c, Column) else re.sub(rf'\b{table.name}\.', '', str(c)) for c in columns)
+        key = (table.name, names, method, opclass)
+        previous = suggestions.get(key)
+        if previous:
+            usage = FieldUsage(calls=previous.calls + usage.calls, time=previous.time + usage.time)
+            reason = previous.reason if reason in previous.reason else f'{previous.reason}, {reason}'
+        suggestions[key] = IndexSuggestion(table=table.name, columns=names, method=method, opclass=opclass,
+                                           calls=usage.calls, time=usage.time, reason=reason)
+
+    with usage_statistics.lock:
+        filters = dict(usage_statistics.filters)
+        sorts = dict(usage_statistics.sorts)
+        combinations = dict(usage_statistics.combinations)
+
+    for (cls, path, op), usage in filters.items():
+        column = resolve(cls, path)
+        if column is None or usage.calls < min_calls:
+            continue
+        if op in trigram_functions:
+            suggest((column,), 'gin', 'gin_trgm_ops', usage, f'{op} (needs pg_trgm)')
+        elif op == 'prefix':
+            suggest((column,), 'btree', 'text_pattern_ops', usage, 'case-sensitive prefix match')
+        elif op in expression_functions:
+            suggest((expression_functions[op](column),), 'btree', None, usage, op)
+        elif op in ('has', 'lacks'):
+            suggest((column,), 'gin', None, usage, op)
+        elif op.startswith('geo.'):
+            suggest((column,), 'gist', None, usage, op)
+        elif op in range_operators:
+            suggest((column,), 'btree', None, usage, f'{op} filter')
+
+    for (cls, field), usage in sorts.items():
+        m = geo_distance_pattern.match(field)
+        column = resolve(cls, m.group('field') if m else field)
+        if column is not None and usage.calls >= min_calls:
+            suggest((column,), 'gist' if m else 'btree', None, usage, 'nearest ordering' if m else 'ordering')
+
+    for (cls, equalities, sort_fields), usage in combinations.items():
+        columns = tuple(resolve(cls, f) for f in equalities + sort_fields)
+        if usage.calls >= min_calls and all(c is not None for c in columns) and len(set(columns)) == len(columns):
+            suggest(columns, 'btree', None, usage, 'equality filter sorted by ' + ', '.join(sort_fields))
+
+    return sorted(suggestions.values(), key=lambda s: s.time, reverse=True)
+
+
+def get_index_report(min_calls: int = 1) -> str:
+    """
+    Suggested indexes as SQL script, commented with their usage
+    :param min_calls: Ignores usages seen in fewer requests
+    :return: CREATE INDEX statements
+    """
+    return '\n'.join(f'-- {s.reason}: {s.calls} requests, {s.time:.3f} s\n{s.ddl}' for s in suggest_indexes(min_calls))
+
+
+# endregion
+
+# region Keyset Pagination
+
+class KeysetField(NamedTuple):
+    field: str
+    column: ColumnElement
+    descending: bool
+
+
+skip_token_types = {
+    'datetime': (datetime, datetime.isoformat, datetime.fromisoformat),
+    'date': (date, date.isoformat, date.fromisoformat),
+    'time': (time, time.isoformat, time.fromisoformat),
+    'decimal': (Decimal, str, Decimal),
+    'uuid': (UUID, str, UUID),
+}
+
+
+def encode_skip_token(values: Tuple[Any, ...]) -> str:
+    """
+    Encodes sorting key values of the last fetched row into an opaque continuation token
+    :param values: Keyset values
+    :return: URL-safe token
+    """
+
+    def encode_value(value):
+        for tag, (t, serializer, _) in skip_token_types.items():
+            if type(value) is t:
+                return {tag: serializer(value)}
+        return value
+
+    data = rapidjson.dumps([encode_value(v) for v in values], ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_skip_token(token: str, size: int) -> Tuple[Any, ...]:
+    """
+    Decodes continuation token created by encode_skip_token
+    :param token: URL-safe token
+    :param size: Expected number of keyset values
+    :return: Keyset values
+    """
+
+    def decode_value(value):
+        if isinstance(value, dict):
+            (tag, data), = value.items()
+            return skip_token_types[tag][2](data)
+        return value
+
+    try:
+        values = rapidjson.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        result = tuple(map(decode_value, values))
+    except (ValueError, KeyError, TypeError):
+        raise ParsingException(f'Invalid {PartConstants.SkipToken}')
+    if len(result) != size:
+        raise ParsingException(f'{PartConstants.SkipToken} does not match {PartConstants.OrderBy}')
+    return result
+
+
+def create_seek_predicate(keyset: Tuple[KeysetField, ...], values: Tuple[Any, ...]) -> ColumnElement:
+    """
+    Creates the predicate selecting rows after the given keyset values. When all the columns are sorted in the same
+    direction, a row-value comparison is used, which btree indexes can serve directly.
+    :param keyset: Sorting columns
+    :param values: Keyset values of the last row of the previous page
+    :return: SqlAlchemy boolean expression
+    """
+    if len({k.descending for k in keyset}) == 1:
+        columns = tuple_(*(k.column for k in keyset))
+        return columns < tuple_(*values) if keyset[0].descending else columns > tuple_(*values)
+
+    return or_(*(and_(*(k.column == v for k, v in zip(keyset[:i], values)),
+                      keyset[i].column < values[i] if keyset[i].descending else keyset[i].column > values[i])
+                 for i in range(len(keyset))))
+
+# endregion
+
+
+class RelationshipStep(NamedTuple):
+    name: str
+    attr: InstrumentedAttribute
+    is_inner: bool
+    entity: type
+
+
+class EntityMetadata:
+    """
+    Mapper-derived information of an entity which query adapters need on every request: column map of the inner
+    (many-to-one) entities, primary key, relationship chains of OData paths and their aliases.
+    Instances are shared process-wide through get_entity_metadata and must be treated as read-only.
+    """
+
+    def __init__(self, cls: type):
+        self.cls: type = cls
+        self.primary_key: str = inspect(cls).primary_key[0].key
+        self.entity_map: Dict[str, int] = {}
+        self.column_map: Dict[str, str] = {}
+        self.chains: Dict[str, Tuple[RelationshipStep, ...]] = {}
+        self.aliases: Dict[str, AliasedClass] = {}
+        self.lock = threading.Lock()
+        self.collect_inner_entities(cls)
+
+    def collect_inner_entities(self, entity: type, path: Tuple[RelationshipProperty, ...] = ()):
+        """
+        Drills down the entity and collects all the related entities recursively.
+        :param entity: SqlAlchemy entity type
+        :param path: Relationship path from the main entity
+        :return:
+        """
+        if self.entity_map.get(entity.__name__):
+            self.entity_map[entity.__name__] += 1
+        else:
+            self.entity_map[entity.__name__] = 1
+
+        for attr in inspect(entity).attrs:
+            if type(attr) is RelationshipProperty:
+                if not attr.uselist and attr.mapper.entity != entity:
+                    if attr.mapper.entity not in map(operator.attrgetter('mapper.entity'), path):
+                        self.collect_inner_entities(attr.mapper.entity, path + (attr,))
+
+            else:
+
+                if entity == self.cls:
+                    self.column_map['.'.join(tuple(map(operator.attrgetter('key'), path)) + (attr.key,))] = \
+                        '{}_{}'.format(entity.__name__, attr.key).lower()
+
+                else:
+                    self.column_map['.'.join(tuple(map(operator.attrgetter('key'), path)) + (attr.key,))] = \
+                        '{}_{}_{}'.format(entity.__name__, self.entity_map[entity.__name__], attr.key).lower()
+
+    def relationship_chain(self, path: str) -> Tuple[RelationshipStep, ...]:
+        """
+        Resolves OData path as like 'city/province' into relationship steps
+        :param path: Slash separated relationship names
+        :return: Relationship attribute, join type and target entity of each step
+        """
+        chain = self.chains.get(path)
+        if chain is None:
+            steps = []
+            entity = self.cls
+            for name in path.split('/'):
+                attr = getattr(entity, name)
+                is_inner = inspect(entity).attrs[name].innerjoin
+                entity = get_type(attr)
+                steps.append(RelationshipStep(name=name, attr=attr, is_inner=is_inner, entity=entity))
+            chain = tuple(steps)
+            with self.lock:
+                self.chains[path] = chain
+        return chain
+
+    def entity_at(self, path: str) -> type:
+        return self.relationship_chain(path)[-1].entity
+
+    def is_collection(self, path: str) -> bool:
+        """
+        Whether any step of the OData path is a one-to-many (or many-to-many) relationship
+        :param path: Slash separated relationship names
+        """
+        return any(step.attr.property.uselist for step in self.relationship_chain(path))
+
+    def alias(self, path: str) -> AliasedClass:
+        """
+        Shared alias of the entity at the end of the given OData path
+        :param path: Slash separated relationship names
+        :return: SqlAlchemy aliased entity named after the path
+        """
+        result = self.aliases.get(path)
+        if result is None:
+            alias = aliased(self.entity_at(path), name=path.replace('/', '_'))
+            with self.lock:
+                result = self.aliases.setdefault(path, alias)
+        return result
+
+
+entity_metadata: Dict[type, EntityMetadata] = {}
+entity_metadata_lock = threading.RLock()
+
+
+def get_entity_metadata(cls: type) -> EntityMetadata:
+    """
+    Returns the process-wide metadata of the entity, inspecting the mapper only the first time
+    :param cls: SqlAlchemy entity type
+    :return: Entity metadata
+    """
+    result = entity_metadata.get(cls)
+    if result is None:
+        with entity_metadata_lock:
+            result = entity_metadata.get(cls)
+            if result is None:
+                result = entity_metadata[cls] = EntityMetadata(cls)
+    return result
+
+
+def clear_entity_metadata(*_):
+    with entity_metadata_lock:
+        entity_metadata.clear()
+
+
+event.listen(Mapper, 'after_configured', clear_entity_metadata)
 
 
 class QueryAdapter:
@@ -83,9 +1256,9 @@ class QueryAdapter:
         self.limit: int = kwargs.pop('limit', None)
         self.count: int = kwargs.pop('count', None)
         self.count_only: bool = False
-        self.entity_map: Dict[str, int] = {}
-        self.column_map: Dict[str, str] = {}
-        self.get_inner_entities(cls)
+        self.metadata: EntityMetadata = get_entity_metadata(cls)
+        self.entity_map: Dict[str, int] = dict(self.metadata.entity_map)
+        self.column_map: Dict[str, str] = dict(self.metadata.column_map)
         self.reserved_identifiers: Dict[str, Any] = {}
         self.extra_columns: Tuple[Column] = extra_columns
         self.aliases: Dict[str, Alias] = {}
@@ -93,6 +1266,25 @@ class QueryAdapter:
         self.bound_params = bound_params
         self.param_list: List[Any, ...] = []
         self.use_row_number: bool = False
+        self.use_keyset: bool = False
+        self.skip_token: Optional[str] = None
+        self.next_skip_token: Optional[str] = None
+        self.delta_token: Optional[str] = None
+        self.delta_field: Optional[str] = None
+        self.last_key: Optional[Tuple[Any, ...]] = None
+        self.with_total_count: bool = False
+        self.total_count: Optional[int] = None
+        self.count_requested: bool = False
+        self.use_statement_cache: bool = False
+        self.filter_shape: Tuple = ()
+        self.expand_fields: Dict[str, Tuple[str, ...]] = {}
+        self.use_projection: bool = False
+        self.projection: Optional[Projection] = None
+        self.aggregation: Optional[Aggregation] = None
+        self.search_terms: Optional[str] = None
+        self.search_rank: Optional[ColumnElement] = None
+        self.timings: Dict[str, float] = {}
+        self.query: Optional[Query] = None
 
     def __hash__(self):
         return id(self.cls) ^ hash(self.fields) ^ hash(self.expand) ^ hash(self.join) ^ hash(self.filter) ^ \
@@ -105,33 +1297,109 @@ class QueryAdapter:
     def parse(self, **kwargs):
         pass
 
-    def get_inner_entities(self, entity: type, path: Tuple[str, ...] = ()):
+    def get_shape_key(self, kind: str, *parts: Any) -> Optional[Tuple]:
         """
-        Drills down the entity and collects all the related entities recursively.
-        :param entity: SqlAlchemy entity type
-        :param path: OData entity path as like '/province/city'
-        :return:
+        Creates statement cache key of the request, which holds no literal values lifted into bound parameters
+        :param kind: Kind of the cached item
+        :param parts: Request parts relevant to the cached item
+        :return: Cache key, or None if the request must not be cached
         """
-        if self.entity_map.get(entity.__name__):
-            self.entity_map[entity.__name__] += 1
-        else:
-            self.entity_map[entity.__name__] = 1
+        if self.use_statement_cache and not self.extra_columns:
+            return (kind, self.cls, self.filter_shape, self.aggregation and self.aggregation.shape,
+                    self.search_terms is not None) + parts
 
-        for attr in inspect(entity).attrs:
-            if type(attr) is RelationshipProperty:
-                if not attr.uselist and attr.mapper.entity != entity:
-                    if attr.mapper.entity not in map(operator.attrgetter('mapper.entity'), path):
-                        self.get_inner_entities(attr.mapper.entity, path + (attr,))
+    @contextmanager
+    def measure(self, phase: str):
+        """
+        Adds the time spent in the block to the timings of the request
+        :param phase: QueryShapeStats field name, as like 'execution_time'
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[phase] = self.timings.get(phase, 0.0) + perf_counter() - start
+
+    def get_shape_description(self) -> str:
+        """
+        Normalized text of the request without the literal values, which identifies its shape in query metrics
+        :return: Entity name followed by the OData query parts
+        """
+        parts = []
+        if self.filter_shape:
+            parts.append((PartConstants.Filter, ' AND '.join(map(format_filter_shape, self.filter_shape))))
+        if self.search_terms is not None:
+            parts.append((PartConstants.Search, '?'))
+        if self.aggregation:
+            parts.append((PartConstants.Apply, ','.join(self.aggregation.shape)))
+        if self.order_by:
+            parts.append((PartConstants.OrderBy, ','.join(re.sub(r"'[^']*'", '?', f'{field} {order}')
+                                                          for field, order in self.order_by)))
+        if self.fields:
+            parts.append((PartConstants.Select, ','.join(getattr(f, 'key', str(f)) for f in self.fields)))
+        if self.expand:
+            parts.append((PartConstants.Expand, ','.join(
+                f"{x}({PartConstants.Select}={','.join(self.expand_fields[x])})" if x in self.expand_fields else x
+                for x in self.expand)))
+        query = '&'.join(f'{k}={v}' for k, v in parts)
+        return f'{self.cls.__name__}?{query}' if query else self.cls.__name__
+
+    def is_projection(self) -> bool:
+        """
+        Whether the query selects plain columns instead of entities, which is the case when projection is enabled and
+        $select is given, and always for $apply aggregations. Not applicable with row number pagination or expanded
+        collections.
+        """
+        return self.aggregation is not None or self.use_projection and bool(self.fields) and not self.use_row_number \
+            and not any(map(self.metadata.is_collection, self.expand))
 
+    def get_projection_columns(self) -> Tuple[ColumnElement, ...]:
+        """
+        Selected columns of the main entity and expanded entities, labeled by their dotted path
+        :return: Labeled columns
+        """
+        fields = tuple(f for f in self.fields if isinstance(f, InstrumentedAttribute))
+        pk = getattr(self.cls, self.metadata.primary_key)
+        if not any(f.key == pk.key for f in fields):
+            fields += (pk,)
+        columns = tuple(f.label(f.key) for f in fields)
+
+        for path in self.expand:
+            entity = self.aliases[path]
+            mapper = inspect(self.metadata.entity_at(path))
+            if path in self.expand_fields:
+                names = self.expand_fields[path]
+                names += tuple(c.key for c in mapper.primary_key if c.key not in names)
             else:
+                names = tuple(c.key for c in mapper.column_attrs)
+            prefix = path.replace('/', '.')
+            columns += tuple(getattr(entity, name).label(f'{prefix}.{name}') for name in names)
 
-                if entity == self.cls:
-                    self.column_map['.'.join(tuple(map(operator.attrgetter('key'), path)) + (attr.key,))] = \
-                        '{}_{}'.format(entity.__name__, attr.key).lower()
+        return columns + tuple(self.extra_columns)
 
-                else:
-                    self.column_map['.'.join(tuple(map(operator.attrgetter('key'), path)) + (attr.key,))] = \
-                        '{}_{}_{}'.format(entity.__name__, self.entity_map[entity.__name__], attr.key).lower()
+    def get_params(self) -> Dict[str, Any]:
+        params = {f'filter_param_{k}': v for k, v in enumerate(self.param_list)}
+        if self.search_terms is not None:
+            params['search_terms'] = self.search_terms
+        return params
+
+    def get_search_vector(self) -> ColumnElement:
+        """
+        tsvector of the entity for $search: its search_vector column (as like a generated tsvector column) if any, or
+        to_tsvector of its search_fields, which must be indexed with the same expression, as like
+        CREATE INDEX ... USING gin (to_tsvector('simple', coalesce(title, '') || ' ' || coalesce(body, '')))
+        :return: SqlAlchemy tsvector expression
+        """
+        if hasattr(self.cls, 'search_vector'):
+            return getattr(self.cls, 'search_vector')
+        if not getattr(self.cls, 'search_fields', None):
+            raise ParsingException(f'{PartConstants.Search} is not supported for {self.cls.__name__}')
+
+        columns = tuple(getattr(self.cls, name) for name in self.cls.search_fields)
+        if len(columns) == 1:
+            return func.to_tsvector(text_search_config, columns[0])
+        document = functools.reduce(lambda a, b: a + ' ' + b, (func.coalesce(c, '') for c in columns))
+        return func.to_tsvector(text_search_config, document)
 
     def get_order_by_field(self, field: str) -> Column:
         """
@@ -139,6 +1407,11 @@ class QueryAdapter:
         :param field: OData entity name, may be nested as like province.city
         :return: SQlAlchemy Column for sorting query
         """
+        if field == search_rank_field and self.search_rank is not None:
+            return self.search_rank
+        m = geo_distance_pattern.match(field)
+        if m:
+            return self.get_order_by_field(m.group('field')).op('<->')(geometry_literal(m.group('value')))
         if '.' in field:
 
             m = re.match(r'(.+)\.(.+)', field)
@@ -173,51 +1446,150 @@ class QueryAdapter:
         :param opt: Options to apply before counting
         :return: SqlAlchemy Query object
         """
-        pk = inspect(self.cls).primary_key[0]
-        _query = session.query(func.count(func.distinct(getattr(self.cls, pk.key))))
+        key = self.get_shape_key('count', tuple(self.join))
+        cached: Optional[Query] = statement_cache.get(key) if key else None
+        if cached:
+            _query = cached.with_session(session)
+        else:
+            _query = self.create_base_count_query(session)
+            if key:
+                statement_cache.put(key, _query.with_session(None))
+
+        if opt:
+            _query = opt(_query).order_by(None)
+
+        if self.aggregation:
+            _query = session.query(func.count()).select_from(_query.subquery())
+
+        if self.param_list or self.search_terms is not None:
+            _query = _query.params(**self.get_params())
+
+        if self.logger and self.logger.isEnabledFor(DEBUG):
+            query_statement = str(_query.statement)
+            query_params = _query.statement.compile().params
+            self.logger.debug(re.sub(r'\s+:(\w+)\s*', r" '{\1}' ", query_statement).format(**query_params))
+
+        return _query
+
+    def create_base_count_query(self, session: Session) -> Query:
+        """
+        Creates the part of count query which depends only on the request shape: joins and filters
+        :param session: SqlAlchemy Session object
+        :return: SqlAlchemy Query object
+        """
+        if self.aggregation:
+            _query = session.query(*(self.aggregation.group_by or self.aggregation.columns)).select_from(self.cls)
+        else:
+            _query = session.query(func.count(func.distinct(getattr(self.cls, self.metadata.primary_key))))
 
         for item in self.join:
             if item not in self.aliases:
-                entity = functools.reduce(
-                    lambda c, p: get_type(getattr(c, p)),
-                    item.split('/'),
-                    self.cls)
-
-                self.aliases[item] = aliased(entity, name=item.replace('/', '_'))
+                self.aliases[item] = self.metadata.alias(item)
 
         for j in self.join:
 
             path = []
             chain = j.split('/')
 
-            def drill_down_relationship(query_entity: Tuple[Query, Entity], attr_name: str) -> Tuple[Query, Entity]:
-                query, entity = query_entity
-                attr = getattr(entity, attr_name)
-                path.append(attr_name)
+            def drill_down_relationship(query: Query, step: RelationshipStep) -> Query:
+                path.append(step.name)
                 path_string = '/'.join(path)
-                is_inner = inspect(entity).attrs[attr_name].innerjoin
                 if path == chain:
-                    return query.join(self.aliases[path_string], attr, isouter=not is_inner), get_type(attr)
-                elif '/'.join(path) in self.join:
-                    return query, get_type(attr)
+                    return query.join(self.aliases[path_string], step.attr, isouter=not step.is_inner)
+                elif path_string in self.join:
+                    return query
                 else:
-                    return query.join(attr, isouter=not is_inner), get_type(attr)
-
-            _query, _ = functools.reduce(drill_down_relationship, chain, (_query.reset_joinpoint(), self.cls))
+                    return query.join(step.attr, isouter=not step.is_inner)
 
-        if opt:
-            _query = opt(_query).order_by(None)
+            _query = functools.reduce(drill_down_relationship, self.metadata.relationship_chain(j),
+                                      _query.reset_joinpoint())
 
         if self.filter:
             _query = _query.filter(*self.filter)
 
-        if self.logger:
-            query_statement = str(_query.statement)
-            query_params = _query.statement.compile().params
-            self.logger.debug(re.sub(r'\s+:(\w+)\s*', r" '{\1}' ", query_statement).format(**query_params))
+        if self.aggregation and self.aggregation.group_by:
+            _query = _query.group_by(*self.aggregation.group_by)
 
         return _query
 
+    def estimate_count(self, session: Session, opt=None) -> Optional[int]:
+        """
+        Estimates the count using PostgreSQL planner statistics without running the query: reltuples of the table for
+        unfiltered queries, and EXPLAIN row estimate of the count query otherwise.
+        :param session: SqlAlchemy Session object
+        :param opt: Options to apply before counting
+        :return: Estimated count, or None if the database cannot estimate it
+        """
+        connection = session.connection()
+        if connection.dialect.name != 'postgresql':
+            return None
+
+        if not self.filter and not self.join and opt is None:
+            table = self.cls.__table__
+            estimate = connection.execute(text('SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:name)'),
+                                          {'name': f'{table.schema}.{table.name}' if table.schema else table.name}
+                                          ).scalar()
+        else:
+            pk = getattr(self.cls, self.metadata.primary_key)
+            estimate = explain_plan(connection, self.create_count_query(session, opt).with_entities(pk))['Plan Rows']
+
+        return int(estimate) if estimate is not None and estimate >= 0 else None
+
+    def analyze_complexity(self, session: Optional[Session] = None, opt=None) -> QueryComplexity:
+        """
+        Scores the parsed request before running it, by the number and nesting depth of joins, leading-wildcard
+        searches and sorting by non-indexed columns. If session is given on PostgreSQL, the EXPLAIN cost of the count
+        query (joins and filters) is added.
+        :param session: SqlAlchemy Session object, only needed for the EXPLAIN cost
+        :param opt: Options to apply before explaining
+        :return: Complexity metrics and the weighted score
+        """
+        def get_sort_column(field: str) -> Any:
+            if '(' in field:
+                return None
+            if '.' in field:
+                path, name = field.rsplit('.', 1)
+                return getattr(self.metadata.entity_at(path.replace('.', '/')), name, None)
+            return getattr(self.cls, field, None)
+
+        paths = set(self.join) | set(self.expand)
+        sort_columns = tuple(get_sort_column(field) for field, _ in self.order_by)
+        metrics = {
+            'joins': sum(len(p.split('/')) for p in paths),
+            'depth': max((len(p.split('/')) for p in paths), default=0),
+            'wildcard_searches': sum(count_wildcard_searches(f) for f in self.filter),
+            'unindexed_sorts': sum(1 for c in sort_columns if c is not None and not is_indexed(c)),
+        }
+        score = sum(complexity_weights[k] * v for k, v in metrics.items())
+
+        cost = None
+        if session is not None and session.connection().dialect.name == 'postgresql':
+            cost = explain_plan(session.connection(), self.create_count_query(session, opt))['Total Cost']
+
+        return QueryComplexity(score=score, cost=cost, **metrics)
+
+    def check_complexity(self, max_score: int, max_cost: Optional[float] = None,
+                         session: Optional[Session] = None, opt=None) -> QueryComplexity:
+        """
+        Rejects the request if its complexity is above the budgets, logging the scores in any case
+        :param max_score: Maximum complexity score
+        :param max_cost: Maximum EXPLAIN cost, which is checked only if given along with session
+        :param session: SqlAlchemy Session object
+        :param opt: Options to apply before explaining
+        :return: Complexity of the request
+        """
+        complexity = self.analyze_complexity(session if max_cost is not None else None, opt)
+        if self.logger:
+            self.logger.info('Query complexity of %s: %s', self.cls.__name__, complexity)
+
+        if complexity.score > max_score:
+            raise ApiError(ErrorMessages.QueryTooComplex, 100400, params=(complexity.score, max_score),
+                           http_status_code=HTTPStatus.BAD_REQUEST)
+        if max_cost is not None and complexity.cost is not None and complexity.cost > max_cost:
+            raise ApiError(ErrorMessages.QueryTooComplex, 100400, params=(complexity.cost, max_cost),
+                           http_status_code=HTTPStatus.BAD_REQUEST)
+        return complexity
+
     def create_baked_count_query(self, session: Session, opt=None) -> baked.Result:
         """
         Creates a cached count query.
@@ -225,35 +1597,28 @@ class QueryAdapter:
         :param opt: Options to apply before counting
         :return: SqlAlchemy Query object
         """
-        pk = inspect(self.cls).primary_key[0]
-
-        _baked_query = bakery(lambda s: s.query(func.count(func.distinct(getattr(self.cls, pk.key)))))
+        pk = self.metadata.primary_key
 
-        entities = (functools.reduce(lambda a, b: get_type(getattr(a, b)), x.split('/'), self.cls) for x in self.join)
+        _baked_query = bakery(lambda s: s.query(func.count(func.distinct(getattr(self.cls, pk)))))
 
         for j in self.join:
 
             path = []
             chain = j.split('/')
 
-            def drill_down_relationship(query_entity: Tuple[BakedQuery, Entity],
-                                        attr_name: str) -> Tuple[BakedQuery, Entity]:
-
-                query, entity = query_entity
-                attr = getattr(entity, attr_name)
-                path.append(attr_name)
-                is_inner = inspect(entity).attrs[attr_name].innerjoin
+            def drill_down_relationship(query: BakedQuery, step: RelationshipStep) -> BakedQuery:
+                path.append(step.name)
                 path_string = '/'.join(path)
                 if path == chain:
                     return query + (
-                        lambda bq: bq.join(self.aliases[path_string], attr, isouter=not is_inner)), get_type(attr)
-                if '/'.join(path) in self.join:
-                    return query, get_type(attr)
+                        lambda bq: bq.join(self.aliases[path_string], step.attr, isouter=not step.is_inner))
+                if path_string in self.join:
+                    return query
                 else:
-                    return query + (lambda bq: bq.join(attr, isouter=not is_inner)), get_type(attr)
+                    return query + (lambda bq: bq.join(step.attr, isouter=not step.is_inner))
 
-            _baked_query, _ = functools.reduce(drill_down_relationship, chain,
-                                               (_baked_query + (lambda bq: bq.reset_joinpoint()), self.cls))
+            _baked_query = functools.reduce(drill_down_relationship, self.metadata.relationship_chain(j),
+                                            _baked_query + (lambda bq: bq.reset_joinpoint()))
 
         if self.filter:
             _baked_query += lambda bq: bq.filter(*self.filter)
@@ -261,7 +1626,7 @@ class QueryAdapter:
         if opt:
             _baked_query += lambda bq: opt(bq)
 
-        return _baked_query(session).params(**{f'param_{k}': v for k, v in enumerate(self.param_list)})
+        return _baked_query(session).params(**self.get_params())
 
     def create_query(self, session: Session, opt=None) -> Query:
         """
@@ -271,123 +1636,273 @@ class QueryAdapter:
         :return: SqlAlchemy Query Object
         """
 
-        if self.fields:
-            pk = inspect(self.cls).primary_key[0].key
+        key = self.get_shape_key('query', tuple(getattr(f, 'key', f) for f in self.fields), tuple(self.expand),
+                                 tuple(sorted(self.expand_fields.items())), self.is_projection())
+        cached: Optional[CachedQuery] = statement_cache.get(key) if key else None
+        if cached:
+            _query = cached.query.with_session(session)
+            self.filter, self.join, self.fields = cached.filter, cached.join, cached.fields
+            self.aliases = dict(cached.aliases)
+            self.projection = cached.projection
+        else:
+            _query = self.create_base_query(session)
+            if key:
+                statement_cache.put(key, CachedQuery(query=_query.with_session(None),
+                                                     filter=self.filter,
+                                                     join=self.join,
+                                                     aliases=dict(self.aliases),
+                                                     fields=self.fields,
+                                                     projection=self.projection))
+
+        if opt:
+            _query = opt(_query)
+
+        if self.use_keyset:
+            keyset = self.get_keyset()
+            if self.projection and any(k.field not in self.projection.labels for k in keyset):
+                raise ParsingException(f'{PartConstants.OrderBy} fields must be selected for keyset pagination')
+            if self.skip_token:
+                _query = _query.filter(create_seek_predicate(keyset, decode_skip_token(self.skip_token, len(keyset))))
+            _query = _query.order_by(*(k.column.desc() if k.descending else k.column.asc() for k in keyset))
+            if self.start and not self.skip_token:
+                _query = _query.offset(self.start)
+            if self.limit:
+                _query = _query.limit(self.limit + 1)
+
+        else:
+            if self.order_by:
+                for field, order in self.order_by:
+
+                    if order == "desc":
+                        _query = _query.order_by(self.get_order_by_field(field).desc())
+                    else:
+                        _query = _query.order_by(self.get_order_by_field(field).asc())
+
+            if self.use_row_number and not self.aggregation:
+                pk = self.metadata.primary_key
+                if self.start or self.limit:
+                    row_number_column = func.dense_rank().over(order_by=getattr(self.cls, pk)).label('row_number')
+                    _query = _query.add_columns(row_number_column).from_self(self.cls, *self.extra_columns)
+                    if self.start:
+                        _query = _query.filter(row_number_column > self.start)
+                    if self.limit:
+                        _query = _query.filter(row_number_column <= self.start + self.limit)
+
+            else:
+                if self.with_total_count:
+                    _query = _query.add_columns(func.count().over().label('total_count'))
+                if self.start:
+                    _query = _query.offset(self.start)
+                if self.limit:
+                    _query = _query.limit(self.limit)
+
+        if self.param_list or self.search_terms is not None:
+            _query = _query.params(**self.get_params())
+
+        if self.logger and self.logger.isEnabledFor(DEBUG):
+            query_statement = str(_query.statement)
+            query_params = _query.statement.compile().params
+            self.logger.debug(re.sub(r'\s?:(\w+)\s*', r" '{\1}' ", query_statement).format(**query_params))
+
+        self.query = _query
+        return _query
+
+    def create_base_query(self, session: Session) -> Query:
+        """
+        Creates the part of query which depends only on the request shape: fields, joins, filters and expansions
+        :param session: SqlAlchemy Session object
+        :return: SqlAlchemy Query Object
+        """
+
+        if self.is_projection():
+            _query = session.query(self.cls)
+        elif self.fields:
+            pk = self.metadata.primary_key
             if getattr(self.cls, pk) not in self.fields:
                 self.fields += (getattr(self.cls, pk),)
             _query = session.query(self.cls).options(load_only(*self.fields))
         else:
             _query = session.query(self.cls)
 
-        if self.extra_columns:
+        if self.extra_columns and not self.is_projection():
             _query = _query.add_columns(*self.extra_columns)
 
-        entities = {k: functools.reduce(lambda a, b: get_type(getattr(a, b)), k.split('/'), self.cls) for k in
-                    self.join}
+        entities = {k: self.metadata.entity_at(k) for k in self.join}
 
         self.filter += tuple(r for e in entities.values() if hasattr(e, 'restrictions') for r in e.restrictions)
 
-        self.join += tuple(e for e in self.expand if e not in self.join)
+        self.join += tuple(e for e in self.expand if e not in self.join and not self.metadata.is_collection(e))
 
         for item in self.join:
             if item not in self.aliases:
-                entity = functools.reduce(
-                    lambda c, p: get_type(getattr(c, p)),
-                    item.split('/'),
-                    self.cls)
-
-                self.aliases[item] = aliased(entity, name=item.replace('/', '_'))
+                self.aliases[item] = self.metadata.alias(item)
 
         for j in self.join:
 
             path = []
             chain = j.split('/')
 
-            def drill_down_relationship(query_entity: Tuple[Query, Entity], attr_name: str) -> Tuple[Query, Entity]:
-                query, entity = query_entity
-                attr = getattr(entity, attr_name)
-                path.append(attr_name)
+            def drill_down_relationship(query: Query, step: RelationshipStep) -> Query:
+                path.append(step.name)
                 path_string = '/'.join(path)
-                is_inner = inspect(entity).attrs[attr_name].innerjoin
                 if path == chain:
-                    return query.join(self.aliases[path_string], attr, isouter=not is_inner), get_type(attr)
-                elif '/'.join(path) in self.join:
-                    return query, get_type(attr)
+                    return query.join(self.aliases[path_string], step.attr, isouter=not step.is_inner)
+                elif path_string in self.join:
+                    return query
                 else:
-                    return query.join(attr, isouter=not is_inner), get_type(attr)
+                    return query.join(step.attr, isouter=not step.is_inner)
 
-            _query, _ = functools.reduce(drill_down_relationship, chain, (_query.reset_joinpoint(), self.cls))
+            _query = functools.reduce(drill_down_relationship, self.metadata.relationship_chain(j),
+                                      _query.reset_joinpoint())
 
         if self.filter:
             _query = _query.filter(*self.filter)
 
-        for x in self.expand:
-
-            path = []
-            chain = x.split('/')
-
-            def drill_down_path(option_entity: Tuple[Any, Entity], attr_name: str) -> Tuple[Any, Entity]:
-                option, entity = option_entity
-                attr = getattr(entity, attr_name)
-                path.append(attr_name)
-
-                path_string = '/'.join(path)
-                if option is None:
-                    if path_string in self.expand:
-                        return contains_eager(attr, alias=self.aliases[path_string]), get_type(attr)
-                    else:
-                        return contains_eager(attr), get_type(attr)
-                else:
-                    if path_string in self.expand:
-                        return option.contains_eager(attr, alias=self.aliases[path_string]), get_type(attr)
-                    else:
-                        return option.contains_eager(attr), get_type(attr)
-
-            _options, _ = functools.reduce(drill_down_path, chain, (None, self.cls))
-
-            if _options:
-                _query = _query.options(_options)
-
-        if opt:
-            _query = opt(_query)
+        if self.aggregation:
+            self.projection = Projection(tuple(c.key for c in self.aggregation.columns))
+            _query = _query.with_entities(*self.aggregation.columns)
+            return _query.group_by(*self.aggregation.group_by) if self.aggregation.group_by else _query
 
-        if self.order_by:
-            for field, order in self.order_by:
+        if self.is_projection():
+            columns = self.get_projection_columns()
+            self.projection = Projection(tuple(c.key for c in columns))
+            return _query.with_entities(*columns)
 
-                if order == "desc":
-                    _query = _query.order_by(self.get_order_by_field(field).desc())
-                else:
-                    _query = _query.order_by(self.get_order_by_field(field).asc())
-
-        if self.use_row_number:
-            pk = inspect(self.cls).primary_key[0].key
-            if self.start or self.limit:
-                row_number_column = func.dense_rank().over(order_by=getattr(self.cls, pk)).label('row_number')
-                _query = _query.add_columns(row_number_column).from_self(self.cls, *self.extra_columns)
-                if self.start:
-                    _query = _query.filter(row_number_column > self.start)
-                if self.limit:
-                    _query = _query.filter(row_number_column <= self.start + self.limit)
+        for x in self.expand:
+            _query = _query.options(self.get_expand_option(x))
 
-        else:
-            if self.start:
-                _query = _query.offset(self.start)
-            if self.limit:
-                _query = _query.limit(self.limit)
+        return _query
 
-        if self.logger:
-            query_statement = str(_query.statement)
-            query_params = _query.statement.compile().params
-            self.logger.debug(re.sub(r'\s?:(\w+)\s*', r" '{\1}' ", query_statement).format(**query_params))
+    def get_expand_option(self, path: str) -> Any:
+        """
+        Loader option of an expanded path. Steps joined by the query (many-to-one) are populated from the joined rows,
+        while the steps from the first collection on are loaded by batched IN queries after the page is fetched, so
+        collections neither multiply the rows nor break $top and $skip.
+        :param path: Slash separated relationship names
+        :return: SqlAlchemy loader option
+        """
+        option = None
+        steps = []
+        for step in self.metadata.relationship_chain(path):
+            steps.append(step.name)
+            path_string = '/'.join(steps)
+            if step.attr.property.uselist or not any(j == path_string or j.startswith(path_string + '/')
+                                                     for j in self.join):
+                loader, kwargs = 'selectinload', {}
+            elif path_string in self.expand:
+                loader, kwargs = 'contains_eager', {'alias': self.aliases[path_string]}
+            else:
+                loader, kwargs = 'contains_eager', {}
+            if option is None:
+                option = (selectinload if loader == 'selectinload' else contains_eager)(step.attr, **kwargs)
+            else:
+                option = getattr(option, loader)(step.attr, **kwargs)
 
-        return _query
+        if path in self.expand_fields:
+            option = option.load_only(*self.expand_fields[path])
+        return option
 
     def create_func(self, session: Session, use_baked_queries: bool = False, opt=None) -> Callable:
-        if use_baked_queries:
+        if self.is_projection():
+            query = self.create_query(session, opt)
+            if self.use_keyset:
+                fetch = functools.partial(self.fetch_keyset_page, query)
+            elif self.with_total_count:
+                fetch = functools.partial(self.fetch_with_total_count, query, full_row=True)
+            else:
+                fetch = query.all
+            return lambda: list(map(self.projection, fetch()))
+        elif self.use_keyset:
+            return functools.partial(self.fetch_keyset_page, self.create_query(session, opt))
+        elif self.with_total_count:
+            if use_baked_queries:
+                return functools.partial(self.fetch_with_total_count, self.create_baked_query(session, opt))
+            else:
+                return functools.partial(self.fetch_with_total_count, self.create_query(session, opt))
+        elif use_baked_queries:
             return self.create_baked_query(session, opt).all
         else:
             return self.create_query(session, opt).all
 
+    def create_stream_func(self, session: Session,
+                           chunk_size: int = STREAM_CHUNK_SIZE,
+                           opt=None) -> Callable[[], Iterator]:
+        """
+        Creates function iterating over the query results over a server-side cursor, loading chunk_size rows at a time
+        instead of materializing the whole result. Collections can not be eagerly loaded along with it.
+        :param session: SQLAlchemy session
+        :param chunk_size: Number of rows fetched and loaded per round-trip
+        :param opt: Query options
+        :return: Function returning the results iterator
+        """
+        query = self.create_query(session, opt).yield_per(chunk_size).execution_options(stream_results=True)
+        if self.is_projection():
+            return lambda: map(self.projection, query)
+        return functools.partial(iter, query)
+
+    def fetch_with_total_count(self, query: Union[Query, baked.Result], full_row: bool = False) -> List[Any]:
+        """
+        Runs query created with total count window column, strips the column from the rows and sets total_count.
+        If the page is empty while skipping rows, total_count remains None and must be queried separately.
+        :param query: Query created in total count mode
+        :param full_row: Return whole rows (ending with the count column) rather than the entities
+        :return: Page items
+        """
+        rows = query.all()
+        if rows:
+            self.total_count = rows[0][-1]
+        elif not self.start:
+            self.total_count = 0
+        return rows if full_row else [row[0] for row in rows]
+
+    def get_keyset(self) -> Tuple[KeysetField, ...]:
+        """
+        Sorting columns of keyset pagination: $orderby fields (or the delta field, if set) followed by the primary key
+        as the tie-breaker. Sorting columns are expected not to be null. Computed sorting expressions, geo.distance
+        and $rank, are not supported, as their values are not loaded along with the entities.
+        :return: Keyset fields
+        """
+        order_by = ((self.delta_field, 'asc'),) if self.delta_field else self.order_by
+        for field, _ in order_by:
+            if field == search_rank_field or geo_distance_pattern.match(field):
+                raise ParsingException(f'{field} is not supported in {PartConstants.OrderBy} of keyset pagination')
+        keyset = tuple(KeysetField(field=field,
+                                   column=self.get_order_by_field(field),
+                                   descending=order == 'desc') for field, order in order_by)
+        pk = self.metadata.primary_key
+        if pk not in (k.field for k in keyset):
+            keyset += (KeysetField(field=pk,
+                                   column=getattr(self.cls, pk),
+                                   descending=keyset[-1].descending if keyset else False),)
+        return keyset
+
+    def fetch_keyset_page(self, query: Query) -> List[Any]:
+        """
+        Runs keyset paginated query, which fetches one extra row to find out whether there is a next page, and sets
+        next_skip_token accordingly. The keyset values of the last row are kept in last_key.
+        :param query: Query created in keyset mode
+        :return: Page items
+        """
+        result = query.all()
+        self.next_skip_token = None
+        self.last_key = None
+        has_next_page = bool(self.limit) and len(result) > self.limit
+        if has_next_page:
+            result = result[:self.limit]
+        if result:
+            last = result[-1]
+            entity = last[0] if isinstance(last, Row) else last
+
+            def get_key_value(field: str):
+                if isinstance(last, Row) and field in last.keys():
+                    return last[field]
+                return functools.reduce(getattr, field.split('.'), entity)
+
+            self.last_key = tuple(get_key_value(k.field) for k in self.get_keyset())
+            if has_next_page:
+                self.next_skip_token = encode_skip_token(self.last_key)
+        return result
+
     def create_baked_query(self, session: Session, opt=None) -> baked.Result:
         """
         Creates SqlAlchemy cached query according to OData filters and joins
@@ -398,7 +1913,7 @@ class QueryAdapter:
         _baked_query = bakery(lambda s: s.query(self.cls))
 
         if self.fields:
-            pk = inspect(self.cls).primary_key[0].key
+            pk = self.metadata.primary_key
             if getattr(self.cls, pk) not in self.fields:
                 self.fields += (getattr(self.cls, pk),)
             _baked_query += lambda bq: bq.options(load_only(*self.fields))
@@ -406,73 +1921,41 @@ class QueryAdapter:
         if self.extra_columns:
             _baked_query += lambda bq: bq.add_columns(*self.extra_columns)
 
-        entities = (functools.reduce(lambda a, b: get_type(getattr(a, b)), x.split('/'), self.cls) for x in self.join)
+        entities = (self.metadata.entity_at(x) for x in self.join)
         self.filter += tuple(r for e in entities if hasattr(e, 'restrictions') for r in getattr(e, 'restrictions'))
 
-        self.join += tuple(e for e in self.expand if e not in self.join)
+        self.join += tuple(e for e in self.expand if e not in self.join and not self.metadata.is_collection(e))
 
         for item in self.join:
             if item not in self.aliases:
-                entity = functools.reduce(
-                    lambda c, p: get_type(getattr(c, p)),
-                    item.split('/'),
-                    self.cls)
-
-                self.aliases[item] = aliased(entity, name=item.replace('/', '_'))
+                self.aliases[item] = self.metadata.alias(item)
 
         for j in self.join:
 
             path = []
             chain = j.split('/')
 
-            def drill_down_relationship(query_entity: Tuple[BakedQuery, Entity],
-                                        attr_name: str) -> Tuple[BakedQuery, Entity]:
-
-                query, entity = query_entity
-                attr = getattr(entity, attr_name)
-                path.append(attr_name)
-                is_inner = inspect(entity).attrs[attr_name].innerjoin
+            def drill_down_relationship(query: BakedQuery, step: RelationshipStep) -> BakedQuery:
+                path.append(step.name)
                 path_string = '/'.join(path)
                 if path == chain:
                     return query + (
-                        lambda bq: bq.join(self.aliases[path_string], attr, isouter=not is_inner)), get_type(attr)
-                if '/'.join(path) in self.join:
-                    return query, get_type(attr)
+                        lambda bq: bq.join(self.aliases[path_string], step.attr, isouter=not step.is_inner))
+                if path_string in self.join:
+                    return query
                 else:
-                    return query + (lambda bq: bq.join(attr, isouter=not is_inner)), get_type(attr)
+                    return query + (lambda bq: bq.join(step.attr, isouter=not step.is_inner))
 
-            _baked_query, _ = functools.reduce(drill_down_relationship, chain,
-                                               (_baked_query + (lambda bq: bq.reset_joinpoint()), self.cls))
+            _baked_query = functools.reduce(drill_down_relationship, self.metadata.relationship_chain(j),
+                                            _baked_query + (lambda bq: bq.reset_joinpoint()))
 
         if self.filter:
             _baked_query += lambda bq: bq.filter(*self.filter)
 
         for x in self.expand:
+            _options = self.get_expand_option(x)
+            _baked_query += lambda bq, option=_options: bq.options(option)
 
-            path = []
-            chain = x.split('/')
-
-            def drill_down_path(option_entity: Tuple[Any, Entity], attr_name: str) -> Tuple[Any, Entity]:
-                option, entity = option_entity
-                attr = getattr(entity, attr_name)
-                path.append(attr_name)
-
-                path_string = '/'.join(path)
-                if option is None:
-                    if path_string in self.expand:
-                        return contains_eager(attr, alias=self.aliases[path_string]), get_type(attr)
-                    else:
-                        return contains_eager(attr), get_type(attr)
-                else:
-                    if path_string in self.expand:
-                        return option.contains_eager(attr, alias=self.aliases[path_string]), get_type(attr)
-                    else:
-                        return option.contains_eager(attr), get_type(attr)
-
-            _options, _ = functools.reduce(drill_down_path, chain, (None, self.cls))
-
-            if _options:
-                _baked_query += lambda bq: bq.options(_options)
 
         if opt:
             _baked_query += lambda bq: opt(bq)
@@ -486,7 +1969,7 @@ class QueryAdapter:
                     _baked_query += lambda bq: bq.order_by(self.get_order_by_field(field).asc())
 
         if self.use_row_number:
-            pk = inspect(self.cls).primary_key[0].key
+            pk = self.metadata.primary_key
             if self.start or self.limit:
                 row_number_column = func.dense_rank().over(order_by=getattr(self.cls, pk)).label('row_number')
                 _baked_query += lambda bq: bq.add_columns(row_number_column).from_self(self.cls, *self.extra_columns)
@@ -495,12 +1978,14 @@ class QueryAdapter:
                 if self.limit:
                     _baked_query += lambda bq: bq.filter(row_number_column <= self.start + self.limit)
         else:
+            if self.with_total_count:
+                _baked_query += lambda bq: bq.add_columns(func.count().over().label('total_count'))
             if self.start:
                 _baked_query += lambda bq: bq.offset(self.start)
             if self.limit:
                 _baked_query += lambda bq: bq.limit(self.limit)
 
-        return _baked_query(session).params(**{f'param_{k}': v for k, v in enumerate(self.param_list)})
+        return _baked_query(session).params(**self.get_params())
 
     def perform_convenience(self, max_items_per_page, default_items_per_page):
         if not self.limit or self.limit > max_items_per_page:
@@ -513,136 +1998,57 @@ class ODataQueryAdapter(QueryAdapter):
     top_pattern = re.compile(fr'{PartConstants.Top}=(?P<top>\d+)')
     skip_pattern = re.compile(fr'{PartConstants.Skip}=(?P<skip>\d+)')
     select_pattern = re.compile(fr'{PartConstants.Select}=(?P<select>\w+)')
+    expand_separator_pattern = re.compile(r',(?![^(]*\))')
+    order_by_pattern = re.compile(r'\s*(?P<field>.+?)(?:\s+(?P<order>asc|desc))?\s*')
+    apply_transformation_pattern = re.compile(r'\s*(?P<method>\w+)\((?P<arguments>.*)\)\s*', re.S)
+    apply_aggregate_pattern = re.compile(r'\s*(?P<path>\$count|[\w/]+)(?:\s+with\s+(?P<method>\w+))?'
+                                         r'\s+as\s+(?P<alias>\w+)\s*')
+    expand_item_pattern = re.compile(fr'\s*(?P<path>[\w/]+)\s*(?:\(\{PartConstants.Select}=(?P<select>[\w,\s]+)\))?\s*')
 
     def __init__(self, cls):
         super().__init__(cls)
+        self.use_fast_parser: bool = False
+        self.use_sargable_rewrite: bool = True
 
     def parse_filter(self, *filters: Tuple[str, ...], extra_columns=()) -> FilterExpression:
 
-        def date_part_func(part: str):
-            def date_part_reverse(part_rev: str, val):
-                return func.date_part(val, part_rev)
-
-            return functools.partial(date_part_reverse, part)
-
-        def containing(a, b: str):
-            return a.in_(b.replace(' ', '').split(','))
-
-        def excluding(a, b: str):
-            return not_(a.in_(b.replace(' ', '').split(',')))
-
-        def array_has(a, b):
-            return a.any(b)
-
-        def array_lacks(a, b):
-            return not_(a.all(b))
-
-        op_map = {
-            'eq': operator.eq,
-            'ne': operator.ne,
-            'gt': operator.gt,
-            'lt': operator.lt,
-            'ge': operator.ge,
-            'le': operator.le,
-            'add': operator.add,
-            'sub': operator.sub,
-            'mul': operator.mul,
-            'div': operator.truediv,
-            'mod': operator.mod,
-            'AND': and_,
-            'OR': or_,
-            'in': containing,
-            'out': excluding,
-            'has': array_has,
-            'lacks': array_lacks
-        }
-
-        func_map = {'substringof': lambda a, b: b.ilike('%{0}%'.format(a)),
-                    'endswith': lambda a, b: a.ilike('%{0}'.format(b)),
-                    'startswith': lambda a, b: a.ilike('{0}%'.format(b)),
-                    'length': func.length,
-                    'indexof': func.position,
-                    'replace': func.replace,
-                    'substring': func.substring,
-                    'tolower': func.lower,
-                    'toupper': func.upper,
-                    'trim': func.trim,
-                    'round': func.round,
-                    'floor': func.floor,
-                    'ceiling': func.ceiling,
-                    'year': date_part_func('year'),
-                    'month': date_part_func('month'),
-                    'day': date_part_func('day'),
-                    'hour': date_part_func('hour'),
-                    'minute': date_part_func('minute'),
-                    'second': date_part_func('second'),
-                    }
-
-        # region Parser Configuration
-
-        operator_ = pp.Regex('|'.join(op_map.keys())).setName('operator')
-        number = pp.Regex(r'[\d\.]+')
-        identifier = pp.Regex(r'[a-z][\w\.]*')
-        str_value = pp.QuotedString("'", unquoteResults=False, escChar='\\')
-        date_value = pp.Regex(r'\d{4}-\d{1,2}-\d{1,2}')
-        collection_value = pp.Suppress('[') + pp.delimitedList(pp.Regex(r'[\w_]+'), combine=True) + pp.Suppress(']')
-        l_par = pp.Suppress('(')
-        r_par = pp.Suppress(')')
-        function_call = pp.Forward()
-        arg = function_call | identifier | date_value | number | collection_value | str_value
-        function_call = pp.Group(identifier + l_par + pp.Optional(pp.delimitedList(arg)) + r_par)
-        param = function_call | arg
-        condition = pp.Group(param + operator_ + param)
-
-        expr = pp.operatorPrecedence(condition, [
-            (pp.CaselessLiteral("AND"), 2, pp.opAssoc.LEFT,),
-            (pp.CaselessLiteral("OR"), 2, pp.opAssoc.LEFT,),
-        ])
-
-        # endregion
-
         try:
             if filters:
 
+                trees = tuple(parse_filter_string(filter_item, self.use_fast_parser) for filter_item in filters)
+                if self.use_sargable_rewrite:
+                    trees = tuple(rewrite_sargable(tree) for tree in trees)
+                if self.bound_params:
+                    trees = tuple(lift_literals(tree, self.param_list) for tree in trees)
+                self.filter_shape += trees
+
+                key = self.get_shape_key('filter', extra_columns)
+                cached: Optional[FilterExpression] = statement_cache.get(key) if key else None
+                if cached:
+                    return cached
+
                 filter_list = []
                 join_list = []
                 alias_map = {}
                 exists_expressions = []
 
                 def parse_identifier(s: Union[str, Tuple]) -> Any:
-                    if type(s) is not str and isinstance(s, collections.Sequence):
+                    if isinstance(s, FilterParameter):
+                        return bindparam(f'filter_param_{s.index}', self.param_list[s.index])
+                    elif type(s) is not str and isinstance(s, collections.Sequence):
                         return parse_single_expression(s)
-                    elif re.match(r"^'?\d{2,4}-\d{1,2}-\d{1,2}'?$", s):
-                        return datetime.strptime(s.strip("'"), '%Y-%m-%d')
-                    elif re.match(r"^'?\d{1,2}:\d{1,2}(:\d{1,2})?'?", s):
-                        return time.fromisoformat(s.strip("'"))
-                    elif re.match(r'^\d+$', s):
-                        return int(s.strip("'"))
-                    elif re.match(r'^[\d.]+$', s):
-                        return float(s.strip("'"))
-                    elif re.match(r"^'.+'$", s) or ',' in s:
-                        return s.strip("'")
                     else:
-                        if s == 'true':
-                            return True
-                        elif s == 'false':
-                            return False
-                        elif s == 'null':
-                            return
+                        value = parse_literal(s)
+                        if value is not IDENTIFIER:
+                            return value
                         else:
                             if '.' in s:
                                 inner_parts = s.split('.')
 
-                                entity = functools.reduce(
-                                    lambda c, p: get_type(getattr(c, p)),
-                                    inner_parts[:-1],
-                                    self.cls)
-
                                 join_item = '/'.join(inner_parts[:-1])
                                 if join_item not in join_list:
                                     join_list.append(join_item)
-                                    alias_map[join_item] = aliased(entity,
-                                                                   name='_'.join(inner_parts[:-1]))
+                                    alias_map[join_item] = self.metadata.alias(join_item)
 
                                 return getattr(alias_map[join_item], inner_parts[-1])
 
@@ -660,7 +2066,9 @@ class ODataQueryAdapter(QueryAdapter):
                                     raise NameError(f"Field {s} not found in class {self.cls}")
 
                 def parse_single_expression(e) -> ColumnElement:
-                    if not isinstance(e, str) and isinstance(e, collections.Sequence):
+                    if isinstance(e, PrefixMatch):
+                        return parse_identifier(e.column).like(e.pattern, escape='\\')
+                    elif not isinstance(e, str) and isinstance(e, collections.Sequence):
                         if len(e) == 1:
                             return parse_single_expression(e[0])
                         else:
@@ -673,7 +2081,10 @@ class ODataQueryAdapter(QueryAdapter):
                                         return func_map[e[0].lower()](*arguments)
                                 else:
                                     if e[1] in op_map:
-                                        operands = tuple(map(parse_identifier, e[::2]))
+                                        if e[1] in collection_operators and not isinstance(e[2], FilterParameter):
+                                            operands = (parse_identifier(e[0]), bindparam(None, parse_collection(e[2])))
+                                        else:
+                                            operands = tuple(map(parse_identifier, e[::2]))
                                         if exists_expressions:
                                             return exists_expressions.pop().any(op_map[e[1]](*operands))
                                         else:
@@ -684,19 +2095,20 @@ class ODataQueryAdapter(QueryAdapter):
                     else:
                         if self.bound_params:
                             self.param_list.append(e)
-                            return bindparam(f'param_{len(self.param_list)}')
+                            return bindparam(f'filter_param_{len(self.param_list) - 1}', e)
                         else:
                             return e
 
-                for filter_item in filters:
-                    parsed_filter = expr.parseString(filter_item)
-
-                    parsed_expression = parse_single_expression(parsed_filter.asList())
+                for tree in trees:
+                    parsed_expression = parse_single_expression(tree)
                     filter_list.append(parsed_expression)
 
-                return FilterExpression(filter_list=tuple(filter_list),
-                                        join_list=tuple(join_list),
-                                        alias_map=alias_map)
+                result = FilterExpression(filter_list=tuple(filter_list),
+                                          join_list=tuple(join_list),
+                                          alias_map=alias_map)
+                if key:
+                    statement_cache.put(key, result)
+                return result
 
         except pp.ParseException as ex:
             raise ParsingException(str(ex))
@@ -704,6 +2116,122 @@ class ODataQueryAdapter(QueryAdapter):
         except AttributeError:
             raise
 
+    def parse_search(self, terms: str):
+        """
+        Parses $search into full-text search predicate over the entity search vector. Matches can be sorted by
+        relevance using $orderby=$rank desc.
+        :param terms: Search terms in web search syntax
+        :return:
+        """
+        self.search_terms = terms.strip()
+        vector = self.get_search_vector()
+        terms_param = bindparam('search_terms', self.search_terms)
+        self.filter += (text_search(vector, terms_param),)
+        self.search_rank = func.ts_rank(vector, func.websearch_to_tsquery(text_search_config, terms_param))
+
+    def get_path_column(self, path: str) -> ColumnElement:
+        """
+        Resolves OData property path as like 'city/name', joining the related entities
+        :param path: Slash separated property path
+        :return: SqlAlchemy column of the (aliased) entity
+        """
+        *relationships, name = path.strip().split('/')
+        if not relationships:
+            if not hasattr(self.cls, name):
+                raise NameError(f"Field {name} not found in class {self.cls}")
+            return getattr(self.cls, name)
+
+        join_item = '/'.join(relationships)
+        if join_item not in self.join:
+            self.join += (join_item,)
+        if join_item not in self.aliases:
+            self.aliases[join_item] = self.metadata.alias(join_item)
+        if not hasattr(self.aliases[join_item], name):
+            raise NameError(f"Field {name} not found in class {self.metadata.entity_at(join_item)}")
+        return getattr(self.aliases[join_item], name)
+
+    def parse_apply(self, text: str):
+        """
+        Parses $apply transformations, supporting filter, groupby and aggregate as like
+        filter(price gt 10)/groupby((city/name), aggregate(price with sum as total, $count as count))
+        Filters must come before the aggregation, and are applied to the rows being aggregated.
+        :param text: $apply value
+        :return:
+        """
+        group_paths = ()
+        aggregates = ()
+        for transformation in split_top_level(text, '/'):
+            m = self.apply_transformation_pattern.fullmatch(transformation)
+            if not m:
+                raise ParsingException(f'Invalid {PartConstants.Apply} transformation {transformation}')
+
+            method, arguments = m.group('method'), m.group('arguments')
+            if method == 'filter':
+                if group_paths or aggregates:
+                    raise ParsingException(f'{PartConstants.Apply} filter after aggregation is not supported')
+                filter_x, join, aliases = self.parse_filter(arguments, extra_columns=tuple(
+                    x.name for x in self.extra_columns))
+                self.filter += filter_x
+                self.join += tuple(j for j in join if j not in self.join)
+                self.aliases.update(aliases)
+            elif method in ('groupby', 'aggregate') and not (group_paths or aggregates):
+                if method == 'groupby':
+                    paths, *rest = split_top_level(arguments, ',')
+                    paths = paths.strip()
+                    if not (paths.startswith('(') and paths.endswith(')')) or len(rest) > 1:
+                        raise ParsingException(f'Invalid {PartConstants.Apply} groupby {arguments}')
+                    group_paths = tuple(p.strip() for p in paths[1:-1].split(','))
+                    if rest:
+                        m = self.apply_transformation_pattern.fullmatch(rest[0])
+                        if not m or m.group('method') != 'aggregate':
+                            raise ParsingException(f'Invalid {PartConstants.Apply} groupby {arguments}')
+                        aggregates = tuple(split_top_level(m.group('arguments'), ','))
+                else:
+                    aggregates = tuple(split_top_level(arguments, ','))
+            else:
+                raise ParsingException(f'{PartConstants.Apply} transformation {method} is not supported')
+
+        group_by = tuple(self.get_path_column(p) for p in group_paths)
+        columns = tuple(c.label(p.replace('/', '.')) for c, p in zip(group_by, group_paths))
+        for aggregate in aggregates:
+            m = self.apply_aggregate_pattern.fullmatch(aggregate)
+            if not m:
+                raise ParsingException(f'Invalid {PartConstants.Apply} aggregate {aggregate}')
+            if m.group('path') == '$count':
+                columns += (func.count().label(m.group('alias')),)
+            elif m.group('method') in aggregate_map:
+                column = aggregate_map[m.group('method')](self.get_path_column(m.group('path')))
+                columns += (column.label(m.group('alias')),)
+            else:
+                raise ParsingException(f'Invalid {PartConstants.Apply} aggregate method in {aggregate}')
+
+        if columns:
+            self.aggregation = Aggregation(group_by=group_by,
+                                           columns=columns,
+                                           shape=group_paths + tuple(a.strip() for a in aggregates))
+
+    def parse_expand(self, *items: str) -> Tuple[Tuple[str, ...], Dict[str, Tuple[str, ...]]]:
+        """
+        Parses $expand items, as like 'city/province' or 'city($select=name,slug)'
+        :param items: $expand items
+        :return: Expanded paths, and the selected fields of each path having nested $select
+        """
+        expand = []
+        expand_fields = {}
+        for item in items:
+            m = self.expand_item_pattern.fullmatch(item)
+            if not m:
+                raise ParsingException(f'Invalid {PartConstants.Expand} item {item}')
+            expand.append(m.group('path'))
+            if m.group('select'):
+                names = tuple(name.strip() for name in m.group('select').split(','))
+                entity = self.metadata.entity_at(m.group('path'))
+                for name in names:
+                    if not hasattr(entity, name):
+                        raise NameError(f"Field {name} not found in class {entity}")
+                expand_fields[m.group('path')] = names
+        return tuple(expand), expand_fields
+
     def parse(self, uri: str = None):
         """
         Parse OData Query String into Adapter properties, to be used when creating SqlAlchemy query afterwards.
@@ -716,14 +2244,22 @@ class ODataQueryAdapter(QueryAdapter):
             parts = parse_qs(uri)
 
             if parts.get(PartConstants.Filter):
-                self.filter, self.join, self.aliases = self.parse_filter(*parts[PartConstants.Filter],
-                                                                         extra_columns=tuple(
-                                                                             x.name for x in self.extra_columns))
+                self.filter, self.join, aliases = self.parse_filter(*parts[PartConstants.Filter],
+                                                                    extra_columns=tuple(
+                                                                        x.name for x in self.extra_columns))
+                self.aliases = dict(aliases)
+
+            if parts.get(PartConstants.Search):
+                self.parse_search(parts[PartConstants.Search][0])
+
+            if parts.get(PartConstants.Apply):
+                self.parse_apply(parts[PartConstants.Apply][0])
 
             if parts.get(PartConstants.OrderBy):
-                sort = parts[PartConstants.OrderBy][0].split(',') if len(parts[PartConstants.OrderBy]) == 1 else \
-                    parts[PartConstants.OrderBy]
-                self.order_by = tuple(s.split(' ') if ' ' in s else (s, 'asc') for s in sort)
+                sort = split_top_level(parts[PartConstants.OrderBy][0], ',') if len(
+                    parts[PartConstants.OrderBy]) == 1 else parts[PartConstants.OrderBy]
+                self.order_by = tuple((m.group('field'), m.group('order') or 'asc')
+                                      for m in map(self.order_by_pattern.fullmatch, sort))
 
             if parts.get(PartConstants.Select):
                 select = parts[PartConstants.Select][0].split(',') if len(parts[PartConstants.Select]) == 1 else \
@@ -731,8 +2267,9 @@ class ODataQueryAdapter(QueryAdapter):
                 self.fields = tuple(getattr(self.cls, n) for n in select)
 
             if parts.get(PartConstants.Expand):
-                self.expand = parts[PartConstants.Expand][0].split(',') if len(
+                expand = self.expand_separator_pattern.split(parts[PartConstants.Expand][0]) if len(
                     parts[PartConstants.Expand]) == 1 else parts[PartConstants.Expand]
+                self.expand, self.expand_fields = self.parse_expand(*expand)
 
             if parts.get(PartConstants.Top):
                 top = parts[PartConstants.Top][0]
@@ -740,3 +2277,12 @@ class ODataQueryAdapter(QueryAdapter):
 
             if parts.get(PartConstants.Skip):
                 self.start = int(parts[PartConstants.Skip][0])
+
+            if parts.get(PartConstants.SkipToken):
+                self.skip_token = parts[PartConstants.SkipToken][0]
+
+            if parts.get(PartConstants.DeltaToken):
+                self.delta_token = parts[PartConstants.DeltaToken][0]
+
+            if parts.get(PartConstants.Count):
+                self.count_requested = parts[PartConstants.Count][0].lower() == 'true'
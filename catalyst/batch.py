@@ -0,0 +1,160 @@
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from http import HTTPStatus
+from typing import Dict, Any, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlsplit, urlencode, parse_qsl
+
+from flask import request, Response, current_app
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from catalyst.adapters import PartConstants, ParsingException
+from catalyst.constants import ConfigKeys, MimeTypes, ErrorMessages, BATCH_MAX_REQUESTS
+from catalyst.data_abstraction import search_using_OData, session_context, get_config, Delta
+from catalyst.errors import ApiError, ErrorDTO
+from catalyst.extensions import serialize, odata
+
+logger = logging.getLogger('orm')
+
+
+class BatchEntity(NamedTuple):
+    cls: type
+    options: Dict[str, Any]
+
+
+class BatchRequest(NamedTuple):
+    id: str
+    method: str
+    url: str
+
+
+batch_entities: Dict[str, BatchEntity] = {}
+
+request_line_pattern = re.compile(r'^(?P<method>[A-Z]+)\s+(?P<url>\S+)(?:\s+HTTP/[\d.]+)?\s*$', re.M)
+
+
+def register_batch_entity(name: str, cls: type, **options):
+    """
+    Makes the entity queryable by $batch sub-requests, as like GET orders?$top=10
+    :param name: Resource name, the last segment of the sub-request URL path
+    :param cls: Entity type
+    :param options: Keyword arguments of search_using_OData, as like query_options or use_keyset
+    :return:
+    """
+    batch_entities[name] = BatchEntity(cls=cls, options=options)
+
+
+def parse_batch() -> List[BatchRequest]:
+    """
+    Reads the sub-requests of current request, either JSON batch ({"requests": [{"id", "method", "url"}]}) or
+    multipart/mixed batch with application/http parts
+    :return: Sub-requests
+    """
+    content_type = request.headers.get('Content-Type', '')
+    if content_type.startswith(MimeTypes.MultipartMixed):
+        m = re.search(r'boundary="?([^";]+)"?', content_type)
+        if not m:
+            raise ApiError(ErrorMessages.InvalidBatch, 100400, http_status_code=HTTPStatus.BAD_REQUEST)
+        parts = request.get_data(as_text=True).split(f'--{m.group(1)}')
+        lines = (request_line_pattern.search(part) for part in parts[1:])
+        return [BatchRequest(id=str(index), method=line.group('method'), url=line.group('url'))
+                for index, line in enumerate(filter(None, lines), 1)]
+
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('requests'), list):
+        raise ApiError(ErrorMessages.InvalidBatch, 100400, http_status_code=HTTPStatus.BAD_REQUEST)
+    return [BatchRequest(id=str(item.get('id', index)), method=str(item.get('method', 'GET')).upper(),
+                         url=item.get('url', ''))
+            for index, item in enumerate(body['requests'], 1)]
+
+
+def get_error_response(status: int, code: int, message: str) -> Tuple[int, ErrorDTO]:
+    return status, ErrorDTO(Code=code, Message=message)
+
+
+def execute_batch_request(db_session: Session, item: BatchRequest) -> Tuple[int, Any]:
+    """
+    Runs an OData GET sub-request against the registered entity
+    :param db_session: SQLAlchemy session to use for the query
+    :param item: Sub-request
+    :return: HTTP status and the body of the sub-response
+    """
+    if item.method != 'GET':
+        return get_error_response(HTTPStatus.METHOD_NOT_ALLOWED, 100405, f'Method {item.method} is not supported')
+
+    url = urlsplit(item.url)
+    name = url.path.rstrip('/').rsplit('/', 1)[-1]
+    entity = batch_entities.get(name)
+    if entity is None:
+        return get_error_response(HTTPStatus.NOT_FOUND, 100404, f'Resource {name} is not found')
+
+    try:
+        result = search_using_OData(db_session, url.query, entity.cls, **entity.options)
+    except ApiError as e:
+        return e.http_status_code, e.purified()
+    except (ParsingException, NameError, ValueError) as e:
+        return get_error_response(HTTPStatus.BAD_REQUEST, 100400, str(e))
+    except SQLAlchemyError as e:
+        logger.error(e)
+        db_session.rollback()
+        return get_error_response(HTTPStatus.INTERNAL_SERVER_ERROR, 100500, ErrorMessages.DatabaseError)
+
+    if not isinstance(result, tuple):
+        return HTTPStatus.OK, result
+    items, count, *extra = result
+    delta: Optional[Delta] = extra.pop() if entity.options.get('delta_column') is not None else None
+
+    def get_link(key: str, token: str) -> str:
+        args = [(k, v) for k, v in parse_qsl(url.query) if k not in (PartConstants.Skip, PartConstants.SkipToken, key)]
+        return f'{url.path}?{urlencode(args + [(key, token)])}'
+
+    return HTTPStatus.OK, odata(count, items,
+                                get_link(PartConstants.SkipToken, extra[0]) if extra and extra[0] else None,
+                                get_link(PartConstants.DeltaToken, delta.token) if delta else None,
+                                delta.deleted if delta else None)
+
+
+def handle_batch(db_session: Optional[Session] = None, concurrency: int = 1, depth: int = 5) -> Response:
+    """
+    Handles OData $batch request of GET sub-requests, returning {"responses": [{"id", "status", "body"}]} serialized
+    by content negotiation. Sub-requests run one after another on the session (so on one connection checkout), or
+    with concurrency above one, on separate sessions of a bounded thread pool, each in the application context.
+    :param db_session: SQLAlchemy session, the scoped session by default
+    :param concurrency: Number of sub-requests run at once
+    :param depth: Serialization depth of each sub-response, as like serialize
+    :return: Flask response
+    """
+    items = parse_batch()
+    max_requests = get_config(ConfigKeys.BatchMaxRequests, BATCH_MAX_REQUESTS)
+    if len(items) > max_requests:
+        raise ApiError(ErrorMessages.BatchTooLarge, 100400, params=(len(items), max_requests),
+                       http_status_code=HTTPStatus.BAD_REQUEST)
+
+    if concurrency > 1:
+        app = current_app._get_current_object()
+
+        def execute(item: BatchRequest) -> Tuple[int, Any]:
+            with app.app_context(), session_context(use_scoped_session=False) as session:
+                return execute_batch_request(session, item)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(execute, items))
+    else:
+        with session_context() if db_session is None else nullcontext(db_session) as session:
+            results = [execute_batch_request(session, item) for item in items]
+
+    return serialize({'responses': [{'id': item.id, 'status': int(status), 'body': body}
+                                    for item, (status, body) in zip(items, results)]}, depth=depth + 2)
+
+
+def register_batch_route(rule: str = '/$batch', **kwargs):
+    """
+    Adds the $batch endpoint to the registered Flask application
+    :param rule: URL rule of the endpoint
+    :param kwargs: Keyword arguments of handle_batch
+    :return:
+    """
+    from catalyst import app
+    app.add_url_rule(rule, 'odata_batch', lambda: handle_batch(**kwargs), methods=['POST'])
@@ -6,11 +6,32 @@ DEFAULT_TIMEZONE = 'Asia/Tehran'
 DEFAULT_CHARSET = 'utf-8'
 ODATA_COUNT = 'odata.count'
 ODATA_VALUE = 'value'
+ODATA_NEXT_LINK = 'odata.nextLink'
+ODATA_COUNT_POLICY = 'odata.countPolicy'
+ODATA_DELTA_LINK = 'odata.deltaLink'
+ODATA_DELETED = 'odata.deleted'
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 DEBUG = os.getenv('FLASK_ENV', 'development') == 'development'
 
 MAX_PAGE_SIZE = 100
 DEFAULT_PAGE_SIZE = 10
+FILTER_CACHE_SIZE = 1024
+STATEMENT_CACHE_SIZE = 512
+STREAM_CHUNK_SIZE = 1000
+QUERY_METRICS_SIZE = 1000
+SERIALIZATION_PLAN_CACHE_SIZE = 256
+RESULT_CACHE_PREFIX = 'odata'
+TEXT_SEARCH_CONFIG = 'simple'
+COUNT_ESTIMATE_THRESHOLD = 100000
+QUERY_COMPLEXITY_BUDGET = 100
+QUERY_COST_BUDGET = 1000000.0
+SLOW_QUERY_THRESHOLD = 1.0
+SLOW_QUERY_EXPLAIN_RATE = 0.1
+SLOW_QUERY_BUFFER_SIZE = 100
+BATCH_MAX_REQUESTS = 20
+DELTA_RETENTION = 7 * 24 * 3600
+REPLICA_MAX_LAG = 5.0
+REPLICA_LAG_CHECK_INTERVAL = 10.0
 MICRO_SERVICE_NAME = "ProductService"
 
 
@@ -30,6 +51,17 @@ class ConfigKeys:
     ServiceDiscoveryUrl = "SERVICE_DISCOVERY_URL"
     SwaggerUrl = "SWAGGER_URL"
     SentryDSN = 'SENTRY_DSN'
+    CountEstimateThreshold = 'COUNT_ESTIMATE_THRESHOLD'
+    ResultCacheEnabled = 'RESULT_CACHE_ENABLED'
+    QueryComplexityBudget = 'QUERY_COMPLEXITY_BUDGET'
+    QueryCostBudget = 'QUERY_COST_BUDGET'
+    SlowQueryThreshold = 'SLOW_QUERY_THRESHOLD'
+    SlowQueryExplainRate = 'SLOW_QUERY_EXPLAIN_RATE'
+    BatchMaxRequests = 'BATCH_MAX_REQUESTS'
+    DeltaRetention = 'DELTA_RETENTION'
+    ReplicaBinds = 'SQLALCHEMY_REPLICA_BINDS'
+    ReplicaMaxLag = 'REPLICA_MAX_LAG'
+    ReplicaLagCheckInterval = 'REPLICA_LAG_CHECK_INTERVAL'
 
 
 class RegExPatterns:
@@ -54,6 +86,7 @@ class MimeTypes:
     CBOR = 'application/cbor'
     URLEncoded = 'application/x-www-form-urlencoded'
     Html = 'text/html'
+    MultipartMixed = 'multipart/mixed'
 
 
 class SerializerFlagString:
@@ -66,3 +99,7 @@ class SerializerFlagString:
 class ErrorMessages:
     ServiceUnavailable = "Service temporarily unavailable. Please try again later."
     DatabaseError = "Database error occurred."
+    QueryTooComplex = "Query is too complex ({0} exceeds the limit of {1})."
+    InvalidBatch = "Invalid batch request."
+    BatchTooLarge = "Batch has too many requests ({0} exceeds the limit of {1})."
+    DeltaTokenExpired = "Delta token has expired, the collection must be fetched again."
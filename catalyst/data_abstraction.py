@@ -1,15 +1,41 @@
+import functools
+import hashlib
 import inspect
+import itertools
 import logging
+import random
+import threading
+import time
+from collections import deque
 from contextlib import contextmanager
+from datetime import datetime
+from enum import Enum
+from urllib.parse import parse_qsl, unquote_plus, urlencode
 
+import rapidjson
+
+from http import HTTPStatus
+
+from flask import request, has_request_context
 from flask_sqlalchemy import models_committed
-from sqlalchemy.orm import Session, Query
-from sqlalchemy import func, Column
-from typing import Callable, Tuple, Union, AnyStr, TypeVar, List, Type, Optional, Generator, Any
+from sqlalchemy.engine import Engine, Connection
+from redis import RedisError
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session, Query, class_mapper
+from sqlalchemy.orm.attributes import instance_state
+from sqlalchemy import func, Column, create_engine, event, text
+from typing import Callable, Tuple, Union, AnyStr, TypeVar, List, Type, Optional, Generator, Any, Iterable, \
+    NamedTuple, Dict, Deque, Set, Sequence
 from toolz import compose
 
-from catalyst.adapters import ODataQueryAdapter
-from catalyst.constants import ConfigKeys, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from catalyst.adapters import ODataQueryAdapter, CountPolicy, EstimatedCount, query_metrics, explain_plan, \
+    usage_statistics, encode_skip_token, decode_skip_token, ParsingException, PartConstants
+from catalyst.constants import ConfigKeys, HeaderKeys, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, DEFAULT_LOCALE, \
+    COUNT_ESTIMATE_THRESHOLD, STREAM_CHUNK_SIZE, RESULT_CACHE_PREFIX, QUERY_COMPLEXITY_BUDGET, QUERY_COST_BUDGET, \
+    SLOW_QUERY_THRESHOLD, SLOW_QUERY_EXPLAIN_RATE, SLOW_QUERY_BUFFER_SIZE, DELTA_RETENTION, ErrorMessages, \
+    REPLICA_MAX_LAG, REPLICA_LAG_CHECK_INTERVAL
+from catalyst.errors import ApiError
+from catalyst.extensions import to_dict, SerializationFlags
 from . import db, app, signals
 
 logger = logging.getLogger('orm')
@@ -28,13 +54,15 @@ def session_context(must_expunge=False,
         db_session: Session = session_factory()
 
     logger.debug('Initiated session %d', id(db_session))
-    yield db_session
-    if must_expunge:
-        db_session.expunge_all()
-    if use_local_context:
-        db_session.commit()
-    if not use_scoped_session:
-        db_session.close()
+    try:
+        yield db_session
+        if must_expunge:
+            db_session.expunge_all()
+        if use_local_context:
+            db_session.commit()
+    finally:
+        if not use_scoped_session:
+            db_session.close()
     logger.debug('Closed session %d', id(db_session))
 
 
@@ -60,6 +88,498 @@ def call_db_func(db_session: Session):
     return FunctionWrapper()
 
 
+def get_config(key: str, default: Any) -> Any:
+    """
+    Reads Flask configuration, falling back to the default if not set or the application is not registered
+    (as like in aiohttp services)
+    """
+    return (app.config.get(key) if app else None) or default
+
+
+def count_search_results(db_session: Session,
+                         adapter: ODataQueryAdapter,
+                         requested: bool,
+                         count_policy: CountPolicy = CountPolicy.Exact,
+                         count_options: Optional[Callable[[Query], Query]] = None,
+                         use_baked_queries: bool = False) -> Optional[int]:
+    """
+    Counts the results of a parsed OData request according to the count policy
+    :param db_session: SQLAlchemy session to use for query
+    :param adapter: Adapter which has parsed the request
+    :param requested: Whether $count=true is requested
+    :param count_policy: How the total count is obtained
+    :param count_options: Query Options for count query
+    :param use_baked_queries: Use bakery for caching ORm queries
+    :return: Count, EstimatedCount, or None if skipped
+    """
+    if count_policy & CountPolicy.OnRequest and not requested:
+        return None
+    with adapter.measure('count_time'):
+        if count_policy & CountPolicy.Estimate:
+            estimate = adapter.estimate_count(db_session, opt=count_options)
+            if estimate is not None and estimate >= get_config(ConfigKeys.CountEstimateThreshold,
+                                                               COUNT_ESTIMATE_THRESHOLD):
+                return EstimatedCount(estimate)
+        return adapter.create_count_func(db_session, use_baked_queries=use_baked_queries, opt=count_options)()
+
+
+# region Result Cache
+
+def get_result_cache():
+    """
+    The Redis cache of OData results, if enabled by RESULT_CACHE_ENABLED configuration. The cache module is imported
+    on demand, since it depends on aioredis.
+    :return: Cache module, or None if the result cache is not available
+    """
+    if not get_config(ConfigKeys.ResultCacheEnabled, False):
+        return None
+    from catalyst.service_invoker import cache
+    return cache if cache.redis else None
+
+
+def get_table_version_key(table_name: str) -> str:
+    return f'{RESULT_CACHE_PREFIX}:version:{table_name}'
+
+
+def bump_table_versions(table_names: Iterable[str]):
+    """
+    Invalidates the cached OData results depending on the given tables
+    :param table_names: Names of the changed tables
+    :return:
+    """
+    cache = get_result_cache()
+    if cache is None:
+        return
+    pipeline = cache.redis.pipeline()
+    for name in table_names:
+        pipeline.incr(get_table_version_key(name))
+    pipeline.execute()
+
+
+def get_changed_tables(target) -> Iterable[str]:
+    """
+    Names of the tables which a change of the given entity may have written to, its own table and the secondary
+    tables of its many-to-many relationships
+    :param target: Changed entity
+    """
+    yield target.__table__.name
+    for prop in class_mapper(type(target)).relationships:
+        if prop.secondary is not None:
+            yield prop.secondary.name
+
+
+def get_result_cache_key(cache, adapter: ODataQueryAdapter, data: AnyStr, vary: Tuple[Any, ...] = ()) -> str:
+    """
+    Creates the cache key of an OData search, from the normalized request, the entity, the versions of the tables
+    involved and the headers affecting serialization
+    :param cache: Result cache, see get_result_cache
+    :param adapter: Adapter which has parsed the request
+    :param data: OData input data
+    :param vary: Extra values which the results depend on, as like the values used by query options
+    :return: Redis key
+    """
+    data = data.decode() if isinstance(data, bytes) else data
+    paths = set(adapter.join) | set(adapter.expand)
+    steps = [step for p in paths for step in adapter.metadata.relationship_chain(p)]
+    tables = sorted({adapter.cls.__table__.name} |
+                    {step.entity.__table__.name for step in steps} |
+                    {step.attr.property.secondary.name for step in steps if step.attr.property.secondary is not None})
+    versions = cache.redis.mget([get_table_version_key(t) for t in tables])
+    headers = (request.headers.get(HeaderKeys.AcceptLanguage),
+               request.headers.get(HeaderKeys.Serialization)) if has_request_context() else ()
+    material = repr((f'{adapter.cls.__module__}.{adapter.cls.__qualname__}',
+                     urlencode(sorted(parse_qsl(unquote_plus(data), keep_blank_values=True))),
+                     adapter.start,
+                     adapter.limit,
+                     tuple(zip(tables, versions)),
+                     headers,
+                     vary))
+    return f'{RESULT_CACHE_PREFIX}:result:{adapter.cls.__table__.name}:{hashlib.sha1(material.encode()).hexdigest()}'
+
+
+def to_cached_items(items: List[Any]) -> List[Any]:
+    """
+    Converts results to the dictionaries being cached, using the serialization settings of the current request
+    :param items: Query results
+    :return: Results as dictionaries
+    """
+    if has_request_context():
+        flags = SerializationFlags(request.headers.get(HeaderKeys.Serialization))
+        locale = request.headers.get(HeaderKeys.AcceptLanguage) or DEFAULT_LOCALE
+    else:
+        flags, locale = SerializationFlags(''), DEFAULT_LOCALE
+    return list(to_dict(items, flags=flags, locale=locale, depth=4))
+
+
+# endregion
+
+# region Slow Queries
+
+class SlowQuery(NamedTuple):
+    entity: str
+    query_string: str
+    endpoint: Optional[str]
+    duration: float
+    sql: Optional[str]
+    params: Dict[str, Any]
+    plan: Optional[Dict[str, Any]]
+    time: datetime
+
+
+slow_queries: Deque[SlowQuery] = deque(maxlen=SLOW_QUERY_BUFFER_SIZE)
+
+
+def get_slow_queries() -> List[SlowQuery]:
+    """
+    Recently captured slow OData queries, oldest first
+    :return: List of the captured queries
+    """
+    return list(slow_queries)
+
+
+def capture_slow_query(db_session: Session, adapter: ODataQueryAdapter, data: AnyStr, duration: float):
+    """
+    Keeps the details of a slow OData query in the slow_queries ring buffer and logs them. A sample of the queries
+    (SLOW_QUERY_EXPLAIN_RATE) is run again with EXPLAIN (ANALYZE, BUFFERS) on PostgreSQL, to include the actual plan.
+    The EXPLAIN runs in a savepoint, and its failure is only logged. SQL and plan are not available for baked queries.
+    :param db_session: SQLAlchemy session which has run the query
+    :param adapter: Adapter which has created the query
+    :param data: OData input data
+    :param duration: Execution time in seconds
+    :return:
+    """
+    sql, params, plan = None, {}, None
+    if adapter.query is not None:
+        dialect = db_session.get_bind().dialect
+        compiled = adapter.query.statement.compile(dialect=dialect, compile_kwargs={'render_postcompile': True})
+        sql, params = str(compiled), compiled.params
+        rate = app.config.get(ConfigKeys.SlowQueryExplainRate)
+        if dialect.name == 'postgresql' and random.random() < (SLOW_QUERY_EXPLAIN_RATE if rate is None else rate):
+            try:
+                with db_session.begin_nested():
+                    plan = explain_plan(db_session.connection(), adapter.query, analyze=True)
+            except SQLAlchemyError as e:
+                logger.error('Failed to explain slow OData query: %s', e)
+
+    item = SlowQuery(entity=adapter.cls.__name__,
+                     query_string=data.decode() if isinstance(data, bytes) else data,
+                     endpoint=(request.endpoint or request.path) if has_request_context() else None,
+                     duration=duration,
+                     sql=sql,
+                     params=params,
+                     plan=plan,
+                     time=datetime.utcnow())
+    slow_queries.append(item)
+    logger.warning('Slow OData query of %s took %.3f s at %s: %s\n%s\nparams: %s\nplan: %s', item.entity,
+                   duration, item.endpoint, item.query_string, sql, params, plan and rapidjson.dumps(plan))
+
+
+# endregion
+
+
+# region Delta Queries
+
+class Delta(NamedTuple):
+    """
+    Delta of a collection request: token of the next delta request and the primary keys of the entities deleted
+    since the given $deltatoken
+    """
+    token: str
+    deleted: List[Dict[str, Any]]
+
+
+tracked_deletions: Set[type] = set()
+
+
+def get_tombstone_key(cls: type) -> str:
+    return f'{RESULT_CACHE_PREFIX}:tombstones:{cls.__table__.name}'
+
+
+def track_deletions(cls: type):
+    """
+    Records the deletions of the entity type (in Redis), so that delta queries over it return them as deleted
+    :param cls: Entity type
+    :return:
+    """
+    tracked_deletions.add(cls)
+
+
+def record_tombstones(changes: Iterable[Tuple[Any, str]]):
+    """
+    Records the primary keys of the deleted entities of tracked types with the deletion time, dropping the records
+    older than DELTA_RETENTION seconds
+    :param changes: Committed changes, as like models_committed signal
+    :return:
+    """
+    from catalyst.service_invoker import cache
+    if not cache.redis:
+        return
+    now = time.time()
+    retention = get_config(ConfigKeys.DeltaRetention, DELTA_RETENTION)
+    pipeline = cache.redis.pipeline()
+    for target, op in changes:
+        if op != 'delete':
+            continue
+        for cls in tracked_deletions:
+            if isinstance(target, cls):
+                key = get_tombstone_key(cls)
+                pipeline.zadd(key, {rapidjson.dumps(list(instance_state(target).identity)): now})
+                pipeline.zremrangebyscore(key, '-inf', now - retention)
+    pipeline.execute()
+
+
+def get_tombstones(cls: type, since: float) -> List[Dict[str, Any]]:
+    if cls not in tracked_deletions:
+        return []
+    from catalyst.service_invoker import cache
+    if not cache.redis:
+        return []
+    mapper = class_mapper(cls)
+    keys = [mapper.get_property_by_column(c).key for c in mapper.primary_key]
+    return [dict(zip(keys, rapidjson.loads(member)))
+            for member in cache.redis.zrangebyscore(get_tombstone_key(cls), f'({since}', '+inf')]
+
+
+def start_delta(cls: type, delta_column: Column, delta_token: Optional[str],
+                started_at: float) -> Tuple[Optional[Callable[[Query], Query]], Any, Optional[float]]:
+    """
+    Decodes the given $deltatoken
+    :param cls: Main entity type for query
+    :param delta_column: Column increasing on insert and update
+    :param delta_token: $deltatoken of the request, if any
+    :param started_at: Time the first page of the response was requested
+    :return: Query option selecting the rows changed since the token (None without token), the delta column value
+        and the time of the token
+    """
+    if not delta_token:
+        return None, None, None
+    try:
+        since, since_time = decode_skip_token(delta_token, 2)
+    except ParsingException:
+        raise ParsingException(f'Invalid {PartConstants.DeltaToken}')
+    if cls in tracked_deletions and since_time < started_at - get_config(ConfigKeys.DeltaRetention, DELTA_RETENTION):
+        raise ApiError(ErrorMessages.DeltaTokenExpired, 100410, http_status_code=HTTPStatus.GONE)
+    if since is None:
+        return None, None, since_time
+    return lambda query: query.filter(delta_column > since), since, since_time
+
+
+def finish_delta(adapter: ODataQueryAdapter, cls: type, since: Any, since_time: Optional[float],
+                 started_at: float) -> Tuple[Optional[str], Optional[Delta]]:
+    """
+    Creates the continuation token of the next page, or the Delta once the last page is fetched, whose high-water
+    mark is the delta column value of the last row returned
+    :param adapter: Adapter which has fetched the page, sorted by the delta column
+    :param cls: Main entity type for query
+    :param since: Delta column value of the given $deltatoken
+    :param since_time: Time of the given $deltatoken
+    :param started_at: Time the first page of the response was requested
+    :return: Continuation token and Delta, either of them None
+    """
+    if adapter.next_skip_token:
+        return encode_skip_token((adapter.next_skip_token, started_at)), None
+    high_water = adapter.last_key[0] if adapter.last_key else since
+    return None, Delta(token=encode_skip_token((high_water, started_at)),
+                       deleted=[] if since_time is None else get_tombstones(cls, since_time))
+
+# endregion
+
+
+# region Read Replicas
+
+class ReplicaPolicy(Enum):
+    """
+    How a read replica is picked among the ones not lagging behind
+    """
+    RoundRobin = 'round_robin'
+    LeastConnections = 'least_connections'
+
+
+postgres_replica_lag = text('SELECT CASE WHEN NOT pg_is_in_recovery() '
+                            'OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+                            'ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END')
+
+
+class ReplicaRouter:
+    """
+    Picks read replica engines by the policy, skipping the replicas whose replication lag exceeds max_lag seconds.
+    Lags are checked at most every lag_check_interval seconds per replica; replicas failing the check are skipped.
+    """
+
+    def __init__(self, engines: Sequence[Engine],
+                 policy: ReplicaPolicy = ReplicaPolicy.RoundRobin,
+                 max_lag: float = REPLICA_MAX_LAG,
+                 lag_check_interval: float = REPLICA_LAG_CHECK_INTERVAL,
+                 lag_query: Optional[Callable[[Connection], float]] = None):
+        self.engines: Tuple[Engine, ...] = tuple(engines)
+        self.policy = policy
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self.lag_query = lag_query
+        self.lags: Dict[Engine, Tuple[float, float]] = {}
+        self.connections: Dict[Engine, int] = dict.fromkeys(self.engines, 0)
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        for engine in self.engines:
+            event.listen(engine, 'checkout', functools.partial(self.count_connection, engine, 1))
+            event.listen(engine, 'checkin', functools.partial(self.count_connection, engine, -1))
+
+    def count_connection(self, engine: Engine, change: int, *_):
+        with self.lock:
+            self.connections[engine] += change
+
+    def get_lag(self, engine: Engine) -> float:
+        """
+        Replication lag of the replica in seconds, which is always zero for databases other than PostgreSQL unless
+        lag_query is given
+        """
+        checked_at, lag = self.lags.get(engine, (0.0, 0.0))
+        now = time.monotonic()
+        if now - checked_at < self.lag_check_interval:
+            return lag
+        try:
+            with engine.connect() as connection:
+                if self.lag_query:
+                    lag = float(self.lag_query(connection))
+                elif engine.dialect.name == 'postgresql':
+                    lag = float(connection.execute(postgres_replica_lag).scalar())
+                else:
+                    lag = 0.0
+        except SQLAlchemyError as e:
+            logger.warning('Replica %s is unavailable: %s', engine.url, e)
+            lag = float('inf')
+        self.lags[engine] = (now, lag)
+        return lag
+
+    def choose(self) -> Optional[Engine]:
+        """
+        Picks a replica engine
+        :return: Engine, or None if all the replicas lag behind
+        """
+        available = [e for e in self.engines if self.get_lag(e) <= self.max_lag]
+        if not available:
+            return None
+        if self.policy == ReplicaPolicy.LeastConnections:
+            return min(available, key=self.connections.__getitem__)
+        return available[next(self.counter) % len(available)]
+
+
+replica_router: Optional[ReplicaRouter] = None
+
+
+def init_read_replicas(*binds: Union[str, Engine],
+                       policy: ReplicaPolicy = ReplicaPolicy.RoundRobin,
+                       lag_query: Optional[Callable[[Connection], float]] = None,
+                       **kwargs):
+    """
+    Configures the read replicas used by the functions called with use_replica, by default the binds listed in
+    SQLALCHEMY_REPLICA_BINDS configuration
+    :param binds: Replica engines, database URIs or names of SQLALCHEMY_BINDS
+    :param policy: How a replica is picked
+    :param lag_query: Function getting the replication lag in seconds over a replica connection
+    :param kwargs: Engine arguments of the replicas given by URI
+    :return:
+    """
+    global replica_router
+
+    def get_engine(bind: Union[str, Engine]) -> Engine:
+        if isinstance(bind, Engine):
+            return bind
+        return create_engine(bind, **kwargs) if '://' in bind else db.get_engine(app, bind=bind)
+
+    binds = binds or get_config(ConfigKeys.ReplicaBinds, ())
+    replica_router = ReplicaRouter([get_engine(b) for b in binds], policy,
+                                   max_lag=get_config(ConfigKeys.ReplicaMaxLag, REPLICA_MAX_LAG),
+                                   lag_check_interval=get_config(ConfigKeys.ReplicaLagCheckInterval,
+                                                                 REPLICA_LAG_CHECK_INTERVAL),
+                                   lag_query=lag_query) if binds else None
+
+
+@event.listens_for(Session, 'after_flush')
+def mark_flushed_writes(session: Session, _):
+    session.info['flushed_writes'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def mark_committed_writes(session: Session):
+    if session.info.pop('flushed_writes', False):
+        session.info['committed_writes_at'] = time.monotonic()
+
+
+@event.listens_for(Session, 'after_rollback')
+def clear_flushed_writes(session: Session):
+    session.info.pop('flushed_writes', None)
+
+
+def must_read_from_primary(session: Session) -> bool:
+    """
+    Whether the session has to read its own writes: it has pending or flushed changes in the current transaction,
+    has committed changes within the last REPLICA_MAX_LAG seconds, or is marked by session.info['read_your_writes']
+    """
+    info = session.info
+    if info.get('read_your_writes') or info.get('flushed_writes') or session.new or session.dirty or session.deleted:
+        return True
+    committed_at = info.get('committed_writes_at')
+    if committed_at is None:
+        return False
+    if time.monotonic() - committed_at < (replica_router.max_lag if replica_router else REPLICA_MAX_LAG):
+        return True
+    del info['committed_writes_at']
+    return False
+
+
+@contextmanager
+def replica_session_context(primary_session: Session) -> Generator[Session, None, None]:
+    """
+    Yields a session over a read replica, or the primary session itself if it must read its own writes (see
+    must_read_from_primary), no replica is configured or all the replicas lag behind.
+    The objects loaded by the replica session are detached when it is closed.
+    :param primary_session: Session of the primary database
+    :return: SQLAlchemy session
+    """
+    must_use_primary = must_read_from_primary(primary_session)
+    engine = None if replica_router is None or must_use_primary else replica_router.choose()
+    if engine is None:
+        yield primary_session
+        return
+
+    db_session = Session(bind=engine)
+    logger.debug('Initiated replica session %d on %s', id(db_session), engine.url)
+    try:
+        yield db_session
+    finally:
+        db_session.close()
+        logger.debug('Closed replica session %d', id(db_session))
+
+
+def routed_to_replica(session_argument: str):
+    """
+    Runs the decorated read-only function on a replica session (see replica_session_context) in place of the given
+    session argument, if it is called with use_replica=True
+    :param session_argument: Name of the session argument
+    :return: Decorator
+    """
+
+    def decorator(f: Callable[..., T]) -> Callable[..., T]:
+        signature = inspect.signature(f)
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs) -> T:
+            arguments = signature.bind(*args, **kwargs)
+            if not arguments.arguments.get('use_replica') or replica_router is None:
+                return f(*args, **kwargs)
+            with replica_session_context(arguments.arguments[session_argument]) as db_session:
+                arguments.arguments[session_argument] = db_session
+                return f(*arguments.args, **arguments.kwargs)
+
+        return wrapper
+
+    return decorator
+
+# endregion
+
+
+@routed_to_replica('db_session')
 def search_using_OData(db_session: Session, data: AnyStr, cls: type, content_type: str = 'uri',
                        adapter_type=ODataQueryAdapter, *,
                        query_options: Optional[Union[Callable[[Query], Query],
@@ -71,7 +591,25 @@ def search_using_OData(db_session: Session, data: AnyStr, cls: type, content_typ
                        use_baked_queries=False,
                        convenient=True,
                        count_only=False,
-                       use_row_number=False) -> Union[Tuple[List[T], int], int]:
+                       use_row_number=False,
+                       use_fast_parser=False,
+                       use_keyset=False,
+                       use_window_count=False,
+                       use_statement_cache=False,
+                       use_projection=False,
+                       result_cache_duration: Optional[int] = None,
+                       result_cache_vary: Tuple[Any, ...] = (),
+                       check_complexity=False,
+                       explain_complexity=False,
+                       collect_metrics=False,
+                       capture_slow_queries=False,
+                       delta_column: Optional[Column] = None,
+                       use_replica=False,
+                       count_policy: CountPolicy = CountPolicy.Exact) -> Union[Tuple[List[T], Optional[int]],
+                                                                               Tuple[List[T], Optional[int],
+                                                                                     Optional[str]],
+                                                                               Tuple[Any, ...],
+                                                                               Optional[int]]:
     """
     Parses OData input and returns list of model object
     :param db_session: SQLAlchemy session to use for query
@@ -87,15 +625,54 @@ def search_using_OData(db_session: Session, data: AnyStr, cls: type, content_typ
     :param convenient: Use security conveniences when trying to query database
     :param count_only: Just return the count not the results
     :param use_row_number: Uses SQL row_number window function for pagination (not limit/offset)
+    :param use_fast_parser: Parses $filter using the hand-written parser instead of pyparsing
+    :param use_keyset: Uses keyset ($skiptoken) pagination, also returning the continuation token of the next page
+    :param use_window_count: Gets the total count along with the page in a single query, using count(*) over ().
+        Not applicable (and two queries are run) with keyset or row number pagination, extra columns, separate
+        count options or joined collections, which would count the joined rows instead of the entities.
+    :param use_statement_cache: Reuses queries built for requests of the same shape, binding the filter values as
+        parameters. Supersedes use_baked_queries.
+    :param use_projection: With $select, queries only the selected columns (including the nested $select of expanded
+        entities) and returns dictionaries instead of ORM objects. Supersedes use_baked_queries.
+    :param count_policy: How the total count is obtained: exact, only if $count=true is requested, and/or estimated
+        by the planner above COUNT_ESTIMATE_THRESHOLD. Skipped counts are None, estimates are EstimatedCount.
+    :param result_cache_duration: Caches the results in Redis for the given seconds, skipping both the page and the
+        count queries on hit. Results are returned as dictionaries, converted with the serialization headers of the
+        request. Entries are invalidated once the tables involved are changed (see notify_subscribers). Only applies
+        with RESULT_CACHE_ENABLED configuration, which is also what makes commits bump the table versions.
+    :param result_cache_vary: Extra values which the results depend on, as like values used in query_options
+    :param check_complexity: Rejects requests scoring above QUERY_COMPLEXITY_BUDGET by raising ApiError
+    :param explain_complexity: Also rejects requests above QUERY_COST_BUDGET, using PostgreSQL EXPLAIN cost
+    :param collect_metrics: Records parse, build, execution and count times of the request per its shape, which are
+        available through adapters.get_query_metrics, and the usage of $filter and $orderby properties, which
+        adapters.suggest_indexes is based on. Requests served from the result cache are not recorded.
+    :param capture_slow_queries: Captures page queries running longer than SLOW_QUERY_THRESHOLD seconds, along with
+        their SQL and a sampled EXPLAIN ANALYZE plan (see capture_slow_query and get_slow_queries)
+    :param delta_column: Enables delta queries over the mapped column, which increases on insert and update in commit
+        order (as like a version column) and is not null. Pages are sorted by the column (ignoring $orderby) using
+        keyset pagination, and the results are the items, the count, the continuation token and the Delta, which is
+        None until the last page. Its token makes a later request with $deltatoken return only the rows changed since,
+        along with the entities deleted since (for types registered by track_deletions). Results are not cached.
+    :param use_replica: Runs the queries on a read replica configured by init_read_replicas, unless the session has
+        written (see replica_session_context)
     :return:
     """
     try:
 
         adapter: ODataQueryAdapter = adapter_type(cls)
         adapter.use_row_number = use_row_number
+        adapter.use_fast_parser = use_fast_parser
+        use_keyset = use_keyset or delta_column is not None
+        adapter.use_keyset = use_keyset
+        adapter.use_statement_cache = use_statement_cache
+        adapter.bound_params = adapter.bound_params or use_statement_cache
+        adapter.use_projection = use_projection
+        use_baked_queries = use_baked_queries and not use_statement_cache
         adapter.extra_columns = extra_columns
         adapter.logger = logger
-        adapter.parse(**{content_type: data})
+        with adapter.measure('parse_time'):
+            adapter.parse(**{content_type: data})
+        use_baked_queries = use_baked_queries and adapter.aggregation is None and delta_column is None
         if convenient:
             adapter.perform_convenience(app.config.get(ConfigKeys.MaxPageSize) or MAX_PAGE_SIZE,
                                         app.config.get(ConfigKeys.DefaultPageSize) or DEFAULT_PAGE_SIZE)
@@ -106,38 +683,180 @@ def search_using_OData(db_session: Session, data: AnyStr, cls: type, content_typ
             count_options = compose(*count_options) if isinstance(count_options, Tuple) else count_options
         else:
             count_options = options
+            adapter.with_total_count = use_window_count and count_policy == CountPolicy.Exact and \
+                not (use_keyset or use_row_number or extra_columns) and \
+                not any(map(adapter.metadata.is_collection, adapter.join))
+
+        if delta_column is not None:
+            adapter.delta_field = delta_column.key
+            started_at = time.time()
+            if adapter.skip_token:
+                try:
+                    adapter.skip_token, started_at = decode_skip_token(adapter.skip_token, 2)
+                except ParsingException:
+                    raise ParsingException(f'Invalid {PartConstants.SkipToken}')
+            delta_filter, since, since_time = start_delta(cls, delta_column, adapter.delta_token, started_at)
+            if delta_filter:
+                options = compose(*filter(None, (options, delta_filter)))
+                count_options = compose(*filter(None, (count_options, delta_filter)))
 
         if adapter.fields:
             adapter.fields += extra_columns
 
-        if count_only:
-            return adapter.create_count_func(db_session, use_baked_queries=use_baked_queries,
-                                             opt=count_options)()
-        else:
-            return (adapter.create_func(db_session, use_baked_queries=use_baked_queries, opt=options)(),
-                    adapter.create_count_func(db_session, use_baked_queries=use_baked_queries,
-                                              opt=count_options)())
+        if check_complexity:
+            adapter.check_complexity(app.config.get(ConfigKeys.QueryComplexityBudget) or QUERY_COMPLEXITY_BUDGET,
+                                     (app.config.get(ConfigKeys.QueryCostBudget) or QUERY_COST_BUDGET)
+                                     if explain_complexity else None,
+                                     session=db_session,
+                                     opt=count_options)
+
+        def count_results(requested: bool) -> Optional[int]:
+            return count_search_results(db_session, adapter, requested, count_policy, count_options,
+                                        use_baked_queries)
+
+        def fetch_items() -> List[T]:
+            with adapter.measure('build_time'):
+                fetch = adapter.create_func(db_session, use_baked_queries=use_baked_queries, opt=options)
+            with adapter.measure('execution_time'):
+                items = fetch()
+            if capture_slow_queries:
+                threshold = app.config.get(ConfigKeys.SlowQueryThreshold) or SLOW_QUERY_THRESHOLD
+                if adapter.timings['execution_time'] > threshold:
+                    capture_slow_query(db_session, adapter, data, adapter.timings['execution_time'])
+            return items
+
+        def fetch_results():
+            if count_only:
+                return count_results(True)
+            elif use_keyset:
+                return fetch_items(), count_results(adapter.count_requested), adapter.next_skip_token
+            elif adapter.with_total_count:
+                items = fetch_items()
+                if adapter.total_count is None:
+                    return items, count_results(True)
+                return items, adapter.total_count
+            else:
+                return fetch_items(), count_results(adapter.count_requested)
+
+        def fetch_and_record():
+            result = fetch_results()
+            if delta_column is not None and not count_only:
+                items, count, _ = result
+                result = (items, count) + finish_delta(adapter, cls, since, since_time, started_at)
+            if collect_metrics:
+                query_metrics.record(adapter.get_shape_description(), adapter.timings,
+                                     0 if count_only else len(result[0]))
+                usage_statistics.record(adapter, adapter.timings.get('execution_time', 0.0))
+            return result
+
+        cache = get_result_cache() if result_cache_duration and delta_column is None else None
+        if cache is None:
+            return fetch_and_record()
+
+        cache_key = get_result_cache_key(cache, adapter, data,
+                                         result_cache_vary + (count_only, use_keyset, count_policy))
+        cached = cache.get_cache_item_sync(cache_key)
+        if cached:
+            count = EstimatedCount(cached['count']) if cached['estimated'] else cached['count']
+            if count_only:
+                return count
+            elif use_keyset:
+                return cached['items'], count, cached['token']
+            return cached['items'], count
+
+        result = fetch_and_record()
+        items, count, *token = (None, result) if count_only else result
+        if not count_only:
+            items = to_cached_items(items)
+            result = (items, count, *token)
+        cache.set_cache_item_sync(cache_key,
+                                  {'items': items,
+                                   'count': None if count is None else int(count),
+                                   'estimated': isinstance(count, EstimatedCount),
+                                   'token': token[0] if token else None},
+                                  result_cache_duration)
+        return result
     finally:
         if expunge_after_all:
             db_session.expunge_all()
 
 
+def stream_using_OData(db_session: Session, data: AnyStr, cls: type, content_type: str = 'uri',
+                       adapter_type=ODataQueryAdapter, *,
+                       query_options: Optional[Union[Callable[[Query], Query],
+                                                     Tuple[Callable[[Query], Query], ...]]] = None,
+                       extra_columns: Tuple[Column, ...] = (),
+                       expunge_after_chunk=True,
+                       convenient=False,
+                       use_fast_parser=False,
+                       use_projection=False,
+                       chunk_size: int = STREAM_CHUNK_SIZE) -> Generator[T, None, None]:
+    """
+    Parses OData input and yields model objects incrementally, using a server-side cursor. Meant for export-like
+    endpoints, along with extensions.serialize_stream, so that memory usage does not grow with the result size.
+    The input is parsed immediately, while the query runs once the results are iterated.
+    :param db_session: SQLAlchemy session to use for query, which must stay open while iterating
+    :param data: OData input data, currently QueryString
+    :param cls: Main entity type for query
+    :param content_type: Teh format of OData input
+    :param adapter_type: Adapter type which can be OData or else
+    :param query_options: Query Options (extra filters, join...) for main query
+    :param extra_columns: Add more column output
+    :param expunge_after_chunk: Kill ORM session after each chunk, so the identity map does not hold every object
+    :param convenient: Applies the page size limits as like search_using_OData (no limit by default)
+    :param use_fast_parser: Parses $filter using the hand-written parser instead of pyparsing
+    :param use_projection: With $select, yields dictionaries of the selected columns instead of ORM objects
+    :param chunk_size: Number of rows fetched per round-trip
+    :return: Generator of the results
+    """
+    adapter: ODataQueryAdapter = adapter_type(cls)
+    adapter.use_fast_parser = use_fast_parser
+    adapter.use_projection = use_projection
+    adapter.extra_columns = extra_columns
+    adapter.logger = logger
+    adapter.parse(**{content_type: data})
+    if convenient:
+        adapter.perform_convenience(app.config.get(ConfigKeys.MaxPageSize) or MAX_PAGE_SIZE,
+                                    app.config.get(ConfigKeys.DefaultPageSize) or DEFAULT_PAGE_SIZE)
+
+    options = compose(*query_options) if isinstance(query_options, Tuple) else query_options
+
+    if adapter.fields:
+        adapter.fields += extra_columns
+
+    def generate() -> Generator[T, None, None]:
+        try:
+            for index, item in enumerate(adapter.create_stream_func(db_session, chunk_size, opt=options)(), 1):
+                yield item
+                if expunge_after_chunk and index % chunk_size == 0:
+                    db_session.expunge_all()
+        finally:
+            if expunge_after_chunk:
+                db_session.expunge_all()
+
+    return generate()
+
+
+@routed_to_replica('session')
 def get_by_slug(cls: Type[T],
                 session: Session,
                 slug: str,
                 natural_key: str = 'slug',
-                query_options: Optional[Callable[[Query], Query]] = None) -> T:
+                query_options: Optional[Callable[[Query], Query]] = None,
+                use_replica=False) -> T:
     if query_options:
         return query_options(session.query(cls).filter(getattr(cls, natural_key) == slug)).one_or_none()
     else:
         return session.query(cls).filter(getattr(cls, natural_key) == slug).one_or_none()
 
 
+@routed_to_replica('session')
 def check_slug_exists(cls: Type[T],
                       session: Session,
                       slug: str,
                       natural_key: str = 'slug',
-                      query_options: Optional[Callable[[Query], Query]] = None) -> bool:
+                      query_options: Optional[Callable[[Query], Query]] = None,
+                      use_replica=False) -> bool:
     if query_options:
         return query_options(session.query(cls.query.filter(getattr(cls, natural_key) == slug))).exists().scalar()
     else:
@@ -158,6 +877,17 @@ def register_signal(callback: Callable[[Any, str], None]):
 
 
 def notify_subscribers(_app, changes):
+    if changes:
+        try:
+            bump_table_versions({name for target, _ in changes if hasattr(target, '__table__')
+                                 for name in get_changed_tables(target)})
+        except RedisError as e:
+            logger.error('Failed to invalidate the cached OData results: %s', e)
+        if tracked_deletions:
+            try:
+                record_tombstones(changes)
+            except RedisError as e:
+                logger.error('Failed to record the deleted entities: %s', e)
     unregister : List[type] = []
     for target, op in changes:
         for t in signals:
@@ -1,11 +1,13 @@
+import functools
 from enum import Enum
 from uuid import UUID
 
 import rapidjson
-from dataclasses import asdict, is_dataclass, dataclass
+from dataclasses import asdict, is_dataclass, dataclass, fields
 
-from flask import request, make_response, g, Response
-from typing import Iterable, Any, get_type_hints, TypeVar, Dict, Union, Type, Mapping, Generator, Optional
+from flask import request, make_response, g, Response, stream_with_context
+from typing import Iterable, Any, get_type_hints, TypeVar, Dict, Union, Type, Mapping, Generator, Optional, \
+    Iterator, Callable, Tuple
 import collections
 from datetime import datetime, date, time, timedelta
 from decimal import Decimal
@@ -14,11 +16,14 @@ from inflector import Inflector
 from shapely.geometry import mapping
 from shapely.geometry.base import BaseGeometry
 
+from catalyst.adapters import PartConstants, EstimatedCount
 from catalyst.constants import RegExPatterns, MimeTypes, HeaderKeys, SerializerFlagString, ODATA_COUNT, ODATA_VALUE, \
-    DEFAULT_LOCALE, DEFAULT_CHARSET, DEFAULT_TIMEZONE
+    ODATA_NEXT_LINK, ODATA_COUNT_POLICY, ODATA_DELTA_LINK, ODATA_DELETED, DEFAULT_LOCALE, DEFAULT_CHARSET, \
+    DEFAULT_TIMEZONE, SERIALIZATION_PLAN_CACHE_SIZE
 from khayyam import JalaliDatetime, JalaliDate
 from pytz import country_timezones, timezone
 import re
+from urllib.parse import urlencode
 from . import serializers
 
 from catalyst.dispatcher import registered_serializers
@@ -62,6 +67,165 @@ def get_request_timezone() -> timezone:
 T = TypeVar('T')
 
 
+class SerializationPlan:
+    """
+    Conversion of Python objects to dictionaries for a combination of to_dict options. The converter of each type is
+    compiled on first use, resolving the type checks, dataclass fields and key inflection once.
+    """
+
+    def __init__(self, flags: SerializationFlags, locale: str, inflection: bool, datetime_formatter: Optional[str]):
+        m = re.match(RegExPatterns.Locale, locale)
+        self.flags = flags
+        self.locale = m.group() if m else DEFAULT_LOCALE
+        self.inflection = inflection
+        self.none = '' if flags.ReplaceNoneWithEmptyString else None
+        self.inflector = Inflector()
+        country: str = self.locale[-2:]
+        self.tz = timezone(country_timezones[country][0] if country in country_timezones else DEFAULT_TIMEZONE)
+        if datetime_formatter:
+            self.datetime_formatter = lambda d: '{{:{}}}'.format(datetime_formatter).format(d)
+        else:
+            self.datetime_formatter = JalaliDatetime.isoformat
+        self.converters: Dict[type, Callable[[Any, int], Any]] = {}
+        self.copied_converters: Dict[type, Callable[[Any, int], Any]] = {}
+
+    def convert(self, obj: Any, depth: int) -> Any:
+        if obj is None:
+            return self.none
+        if depth == 0:
+            return
+        t = type(obj)
+        converter = self.converters.get(t)
+        if converter is None:
+            converter = self.converters[t] = self.compile(t, copied=False)
+        return converter(obj, depth)
+
+    def convert_copied(self, obj: Any, depth: int) -> Any:
+        """
+        Converts a value inside a dataclass, the way to_dict converts it after dataclasses.asdict, which turns the
+        inner dataclasses into dictionaries (along with the lists, tuples and dictionaries holding them)
+        """
+        if obj is None:
+            return self.none
+        if depth == 0:
+            return
+        t = type(obj)
+        converter = self.copied_converters.get(t)
+        if converter is None:
+            converter = self.copied_converters[t] = self.compile(t, copied=True)
+        return converter(obj, depth)
+
+    def get_key(self, key: Any) -> Any:
+        return self.inflector.underscore(key) if self.inflection else key
+
+    def compile(self, t: type, copied: bool) -> Callable[[Any, int], Any]:
+        """
+        Creates the converter of the type, taking the object and the depth
+        :param t: Object type
+        :param copied: Whether the objects are inside a dataclass
+        :return: Converter
+        """
+        flags = self.flags
+        if is_dataclass(t) and not issubclass(t, type):
+            names = tuple(f.name for f in fields(t))
+            if copied:
+                keys = tuple((name, self.get_key(name), flags.IncludeNulls) for name in names)
+                return lambda obj, depth: self.convert_fields(obj, depth - 1, keys)
+            annotations = get_type_hints(t)
+            keys = tuple((name, self.get_key(name),
+                          flags.IncludeNulls or (flags.ReplaceNoneWithEmptyString and annotations[name]) == str)
+                         for name in names)
+            return lambda obj, depth: self.convert_fields(obj, depth, keys)
+
+        converter = self.compile_value(t, copied)
+        if issubclass(t, type):
+            return lambda obj, depth: asdict(obj) if is_dataclass(obj) else converter(obj, depth)
+        return converter
+
+    def convert_fields(self, obj: Any, depth: int, keys: Tuple[Tuple[str, Any, bool], ...]) -> Dict[Any, Any]:
+        result = {}
+        convert = self.convert_copied
+        for name, key, keep_none in keys:
+            value = getattr(obj, name)
+            if value is not None or keep_none:
+                result[key] = convert(value, depth)
+        return result
+
+    def compile_value(self, t: type, copied: bool) -> Callable[[Any, int], Any]:
+        flags = self.flags
+        if issubclass(t, BaseGeometry):
+            return lambda obj, _: mapping(obj)
+        elif any(issubclass(t, parent) for parent in (int, str, bytes, float, bool)):
+            return lambda obj, _: obj
+        elif issubclass(t, Enum):
+            return lambda obj, _: obj.value
+        elif t is Decimal:
+            return lambda obj, _: float(obj)
+        elif t is UUID:
+            return lambda obj, _: obj.hex
+        elif t in (datetime, date, time):
+            return self.compile_temporal(t)
+        elif issubclass(t, timedelta):
+            return lambda obj, _: re.sub(r'(?<=[^1-9])0[YMDHS]', '',
+                                         'P{year}Y{month}M{day}DT{hour}H{minute}M{second}S'
+                                         .format(year=obj.days // 365,
+                                                 month=(obj.days % 365) // 30,
+                                                 day=obj.days % 30,
+                                                 hour=obj.seconds // 3600,
+                                                 minute=(obj.seconds % 3600) // 60,
+                                                 second=obj.seconds % 60))
+        elif issubclass(t, collections.Mapping):
+            convert = self.convert_copied if copied and issubclass(t, dict) else self.convert
+            include_nulls = flags.IncludeNulls
+            if self.inflection:
+                underscore = self.inflector.underscore
+                return lambda obj, depth: {underscore(k): convert(v, depth - 1)
+                                           for k, v in obj.items()
+                                           if v is not None
+                                           or include_nulls}
+            return lambda obj, depth: {k: convert(v, depth - 1)
+                                       for k, v in obj.items()
+                                       if v is not None
+                                       or include_nulls}
+        elif issubclass(t, Iterable) or issubclass(t, collections.Sequence):
+            convert = self.convert_copied if copied and issubclass(t, (list, tuple)) else self.convert
+            container = t if issubclass(t, collections.Sequence) else tuple
+            include_nulls = flags.IncludeNulls
+            return lambda obj, depth: container(convert(item, depth - 1)
+                                                for item in obj
+                                                if item is not None
+                                                or include_nulls)
+        else:
+            convert = self.convert
+            return lambda obj, depth: {attr: convert(getattr(obj, attr), depth - 1)
+                                       for attr in vars(obj) if not attr.startswith('_')}
+
+    def compile_temporal(self, t: type) -> Callable[[Any, int], Any]:
+        flags, tz, formatter = self.flags, self.tz, self.datetime_formatter
+        if not self.locale.startswith('fa-') or t is time:
+            return lambda obj, _: obj.isoformat()
+        elif t is date:
+            if flags.IgnoreLocaleCalendar:
+                return lambda obj, _: obj.isoformat()
+            return lambda obj, _: JalaliDate(obj).isoformat()
+        elif flags.IgnoreLocaleCalendar:
+            if flags.IgnoreLocaleTimeZone:
+                return lambda obj, _: obj.isoformat()
+            return lambda obj, _: tz.fromutc(obj).isoformat() if obj.tzinfo is None else obj.astimezone(tz)
+        elif flags.IgnoreLocaleTimeZone:
+            return lambda obj, _: formatter(JalaliDatetime(obj))
+        return lambda obj, _: formatter(JalaliDatetime(tz.fromutc(obj) if obj.tzinfo is None else obj.astimezone(tz)))
+
+
+@functools.lru_cache(maxsize=SERIALIZATION_PLAN_CACHE_SIZE)
+def get_serialization_plan(flags: Tuple[bool, ...], locale: str, inflection: bool,
+                           datetime_formatter: Optional[str]) -> SerializationPlan:
+    serialization_flags = SerializationFlags('')
+    (serialization_flags.IncludeNulls, serialization_flags.ReplaceNoneWithEmptyString,
+     serialization_flags.IgnoreLocaleCalendar, serialization_flags.IgnoreLocaleTimeZone) = flags
+    return SerializationPlan(serialization_flags, locale, inflection, datetime_formatter)
+
+
 def to_dict(obj: T, *,
             flags: SerializationFlags = SerializationFlags(''),
             locale: str = DEFAULT_LOCALE,
@@ -77,7 +241,6 @@ def to_dict(obj: T, *,
     :return: Python dictionary
     """
 
-    inflector = Inflector()
     if obj is None:
         if flags.ReplaceNoneWithEmptyString:
             return ''
@@ -87,117 +250,13 @@ def to_dict(obj: T, *,
     if depth == 0:
         return
 
-    m = re.match(RegExPatterns.Locale, locale)
-    t = type(obj)
-    if m:
-        locale = m.group()
-    else:
-        locale = DEFAULT_LOCALE
-
-    if is_dataclass(obj):
-        annotations = get_type_hints(type(obj))
-        res = asdict(obj)
-
-        return {inflector.underscore(k) if inflection else k: to_dict(res[k], flags=flags,
-                                                                      locale=locale,
-                                                                      depth=depth,
-                                                                      inflection=inflection,
-                                                                      datetime_formatter=datetime_formatter)
-                for k in res
-                if res[k] is not None
-                or flags.IncludeNulls
-                or (flags.ReplaceNoneWithEmptyString and annotations[k]) == str}
-    elif issubclass(t, BaseGeometry):
-        return mapping(obj)
-    elif any(issubclass(t, parent) for parent in (int, str, bytes, float, bool)):
+    if not uuid_hex and type(obj) is UUID:
         return obj
-    elif issubclass(t, Enum):
-        return obj.value
-    elif t is Decimal:
-        return float(obj)
-    elif t is UUID:
-        if uuid_hex:
-            return obj.hex
-        else:
-            return obj
-    elif t in (datetime, date, time):
-        country: str = locale[-2:]
-        if country in country_timezones:
-            tz = timezone(country_timezones[country][0])
-        else:
-            tz = timezone(DEFAULT_TIMEZONE)
-        if locale.startswith('fa-'):
-            if t is datetime:
-                if flags.IgnoreLocaleCalendar:
-                    if flags.IgnoreLocaleTimeZone:
-                        return obj.isoformat()
-                    if obj.tzinfo is None:
-                        return tz.fromutc(obj).isoformat()
-                    else:
-                        return obj.astimezone(tz)
-                else:
-                    if datetime_formatter:
-                        formatter = lambda d: '{{:{}}}'.format(datetime_formatter).format(d)
-                    else:
-                        formatter = JalaliDatetime.isoformat
 
-                    if flags.IgnoreLocaleTimeZone:
-                        return formatter(JalaliDatetime(obj))
-                    if obj.tzinfo is None:
-                        return formatter(JalaliDatetime(tz.fromutc(obj)))
-                    else:
-                        return formatter(JalaliDatetime(obj.astimezone(tz)))
-            elif t is date:
-                if flags.IgnoreLocaleCalendar:
-                    return obj.isoformat()
-                else:
-                    return JalaliDate(obj).isoformat()
-            elif t is time:
-                return obj.isoformat()
-        else:
-            return obj.isoformat()
-    elif isinstance(obj, timedelta):
-        return re.sub(r'(?<=[^1-9])0[YMDHS]', '',
-                      'P{year}Y{month}M{day}DT{hour}H{minute}M{second}S'
-                      .format(year=obj.days // 365,
-                              month=(obj.days % 365) // 30,
-                              day=obj.days % 30,
-                              hour=obj.seconds // 3600,
-                              minute=(obj.seconds % 3600) // 60,
-                              second=obj.seconds % 60))
-
-    elif isinstance(obj, collections.Mapping):
-        return {inflector.underscore(k) if inflection else k: to_dict(obj[k],
-                                                                      flags=flags,
-                                                                      locale=locale,
-                                                                      depth=depth - 1,
-                                                                      inflection=inflection,
-                                                                      datetime_formatter=datetime_formatter)
-                for k in obj
-                if obj[k] is not None
-                or flags.IncludeNulls}
-
-    elif isinstance(obj, Iterable) or isinstance(obj, collections.Sequence):
-
-        gen = (to_dict(item,
-                       flags=flags,
-                       locale=locale,
-                       depth=depth - 1,
-                       inflection=inflection,
-                       datetime_formatter=datetime_formatter)
-               for item in obj
-               if item is not None
-               or flags.IncludeNulls)
-
-        return t(gen) if isinstance(obj, collections.Sequence) else tuple(gen)
-    else:
-        return {attr: to_dict(getattr(obj, attr),
-                              flags=flags,
-                              locale=locale,
-                              depth=depth - 1,
-                              inflection=inflection,
-                              datetime_formatter=datetime_formatter)
-                for attr in vars(obj) if not attr.startswith('_')}
+    plan = get_serialization_plan((flags.IncludeNulls, flags.ReplaceNoneWithEmptyString,
+                                   flags.IgnoreLocaleCalendar, flags.IgnoreLocaleTimeZone),
+                                  locale, inflection, datetime_formatter)
+    return plan.convert(obj, depth)
 
 
 def raw_serialize(data: Any, mime_type: str, depth: int = 5, inflection: bool = False):
@@ -246,12 +305,101 @@ def serialize(result: object, depth: int = 5, inflection: bool = False) -> Respo
     return resp
 
 
+def serialize_stream(result: Union[Iterable, Mapping], depth: int = 5, inflection: bool = False) -> Response:
+    """
+    Serialize results to JSON as a chunked response, converting the items one by one while they are sent.
+    Iterators (as like the results of data_abstraction.stream_using_OData), either directly or as values of the
+    result mapping (as like the odata function output), are written as JSON arrays.
+    :param result: Iterable of objects, or mapping containing iterators
+    :return: Flask streaming response
+    """
+    flags = SerializationFlags(request.headers.get(HeaderKeys.Serialization))
+    locale = request.headers.get(HeaderKeys.AcceptLanguage) or DEFAULT_LOCALE
+
+    def dumps(obj: Any, obj_depth: int) -> str:
+        return rapidjson.dumps(to_dict(obj,
+                                       flags=flags,
+                                       locale=locale,
+                                       depth=obj_depth,
+                                       inflection=inflection),
+                               ensure_ascii=False,
+                               sort_keys=True)
+
+    def generate_array(items: Iterable, items_depth: int) -> Generator[str, None, None]:
+        yield '['
+        separator = ''
+        for item in items:
+            if item is not None or flags.IncludeNulls:
+                yield separator + dumps(item, items_depth)
+                separator = ','
+        yield ']'
+
+    def generate() -> Generator[str, None, None]:
+        if isinstance(result, Mapping):
+            inflector = Inflector()
+            yield '{'
+            separator = ''
+            for key in sorted(result):
+                value = result[key]
+                if value is not None or flags.IncludeNulls:
+                    yield f'{separator}{rapidjson.dumps(inflector.underscore(key) if inflection else key)}:'
+                    if isinstance(value, Iterator):
+                        yield from generate_array(value, depth - 2)
+                    else:
+                        yield dumps(value, depth - 1)
+                    separator = ','
+            yield '}'
+        else:
+            yield from generate_array(result, depth - 1)
+
+    return Response(stream_with_context(generate()), content_type=f'{MimeTypes.JSON}; charset={DEFAULT_CHARSET}')
+
+
 U = TypeVar('U')
 
 
-def odata(count: int, items: Generator[U, None, None]) -> Dict[str, Union[int, Iterable[U]]]:
-    return {ODATA_COUNT: count,
-            ODATA_VALUE: items}
+def odata(count: Optional[int],
+          items: Generator[U, None, None],
+          next_link: Optional[str] = None,
+          delta_link: Optional[str] = None,
+          deleted: Optional[Iterable[Dict[str, Any]]] = None) -> Dict[str, Union[int, str, Iterable[U]]]:
+    result = {ODATA_COUNT: count,
+              ODATA_VALUE: items}
+    if count is None:
+        result[ODATA_COUNT_POLICY] = 'none'
+    elif isinstance(count, EstimatedCount):
+        result[ODATA_COUNT] = int(count)
+        result[ODATA_COUNT_POLICY] = 'estimate'
+    if next_link:
+        result[ODATA_NEXT_LINK] = next_link
+    if delta_link:
+        result[ODATA_DELTA_LINK] = delta_link
+    if deleted:
+        result[ODATA_DELETED] = deleted
+    return result
+
+
+def get_next_link(skip_token: Optional[str]) -> Optional[str]:
+    """
+    Creates the URL of the next page of the current request, carrying the keyset continuation token
+    :param skip_token: Token returned by keyset paginated search
+    :return: Next page URL, or None if there is no next page
+    """
+    if skip_token:
+        args = [(k, v) for k, v in request.args.items(multi=True)
+                if k not in (PartConstants.Skip, PartConstants.SkipToken)]
+        return f'{request.base_url}?{urlencode(args + [(PartConstants.SkipToken, skip_token)])}'
+
+
+def get_delta_link(delta_token: str) -> str:
+    """
+    Creates the URL of the next delta request of the current request
+    :param delta_token: Token of the Delta returned by search in delta mode
+    :return: Delta URL
+    """
+    args = [(k, v) for k, v in request.args.items(multi=True)
+            if k not in (PartConstants.Skip, PartConstants.SkipToken, PartConstants.DeltaToken)]
+    return f'{request.base_url}?{urlencode(args + [(PartConstants.DeltaToken, delta_token)])}'
 
 
 def get_header_cache_key():
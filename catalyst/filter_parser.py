@@ -0,0 +1,142 @@
+"""
+Hand-written lexer and precedence-climbing parser for OData $filter expressions.
+It produces the same nested structure as the pyparsing grammar in catalyst.adapters, so ODataQueryAdapter can consume
+either one interchangeably.
+"""
+import re
+from typing import Iterable, Optional, Pattern, Tuple, Union
+
+Node = Union[str, Tuple]
+
+
+class ParsingException(Exception):
+    pass
+
+
+class FilterLexer:
+    """
+    Lazy scanner over the $filter text. Tokens are read on demand by the parser according to the expected token class,
+    so trailing text which the parser never asks for is never scanned (the same as pyparsing's parseString).
+    """
+    whitespace = re.compile(r'\s*')
+    value_pattern = re.compile(r"""(?P<date>\d{4}-\d{1,2}-\d{1,2})
+                                  |(?P<number>[\d.]+)
+                                  |(?P<identifier>[a-z][\w.]*)
+                                  |\[\s*(?P<collection>\w+(?:,\w+)*)\s*]
+                                  |(?P<string>'(?:[^'\n\r\\]|\\.)*')""", re.X)
+    connective_pattern = re.compile(r'AND|OR', re.I)
+
+    def __init__(self, text: str, operator_pattern: Pattern):
+        self.text = text
+        self.pos = 0
+        self.operator_pattern = operator_pattern
+
+    def match(self, pattern: Pattern) -> Optional[re.Match]:
+        start = self.whitespace.match(self.text, self.pos).end()
+        m = pattern.match(self.text, start)
+        if m:
+            self.pos = m.end()
+        return m
+
+    def literal(self, char: str) -> bool:
+        start = self.whitespace.match(self.text, self.pos).end()
+        if self.text.startswith(char, start):
+            self.pos = start + len(char)
+            return True
+        return False
+
+    def value(self) -> Optional[Tuple[str, str]]:
+        m = self.match(self.value_pattern)
+        if m:
+            return m.lastgroup, m.group(m.lastgroup)
+
+    def operator(self) -> Optional[str]:
+        m = self.match(self.operator_pattern)
+        if m:
+            return m.group()
+
+    def connective(self) -> Optional[str]:
+        m = self.match(self.connective_pattern)
+        if m:
+            return m.group().upper()
+
+    def error(self, expected: str) -> ParsingException:
+        start = self.whitespace.match(self.text, self.pos).end()
+        return ParsingException(f'Expected {expected}, found {self.text[start:start + 1]!r} (at char {start})')
+
+
+class FilterParser:
+    """
+    Precedence-climbing parser of OData $filter expressions. Chains of the same connective are kept flat, as like
+    ('a', 'AND', 'b', 'AND', 'c'). Unlike the pyparsing grammar, nested function calls are accepted as arguments.
+    """
+    precedence = {'AND': 2, 'OR': 1}
+
+    def __init__(self, operators: Iterable[str]):
+        self.operator_pattern = re.compile('|'.join(operators))
+
+    def parse(self, text: str) -> Tuple:
+        """
+        Parses $filter text
+        :param text: Raw $filter value
+        :return: Nested tuples of tokens, wrapped in a single item tuple
+        """
+        return self.parse_expression(FilterLexer(text, self.operator_pattern)),
+
+    def parse_expression(self, lexer: FilterLexer, min_precedence: int = 1) -> Node:
+        result = self.parse_term(lexer)
+        while True:
+            position = lexer.pos
+            connective = lexer.connective()
+            if connective is None or self.precedence[connective] < min_precedence:
+                lexer.pos = position
+                return result
+
+            level = self.precedence[connective]
+            chain = [result]
+            while connective is not None and self.precedence[connective] == level:
+                try:
+                    operand = self.parse_expression(lexer, level + 1)
+                except ParsingException:
+                    lexer.pos = position
+                    return tuple(chain) if len(chain) > 1 else result
+                chain += [connective, operand]
+                position = lexer.pos
+                connective = lexer.connective()
+
+            lexer.pos = position
+            result = tuple(chain)
+
+    def parse_term(self, lexer: FilterLexer) -> Node:
+        if lexer.literal('('):
+            result = self.parse_expression(lexer)
+            if not lexer.literal(')'):
+                raise lexer.error("')'")
+            return result
+
+        left = self.parse_param(lexer)
+        operator = lexer.operator()
+        if operator is None:
+            raise lexer.error('operator')
+        right = self.parse_param(lexer)
+        return left, operator, right
+
+    def parse_param(self, lexer: FilterLexer) -> Node:
+        token = lexer.value()
+        if token is None:
+            raise lexer.error('value')
+        kind, text = token
+        if kind == 'identifier' and lexer.literal('('):
+            return self.parse_arguments(lexer, text)
+        return text
+
+    def parse_arguments(self, lexer: FilterLexer, name: str) -> Tuple:
+        arguments = [name]
+        if lexer.literal(')'):
+            return tuple(arguments)
+        while True:
+            arguments.append(self.parse_param(lexer))
+            if lexer.literal(')'):
+                return tuple(arguments)
+            if not lexer.literal(','):
+                raise lexer.error("',' or ')'")
@@ -0,0 +1,74 @@
+import timeit
+
+from catalyst.adapters import filter_grammar, fast_filter_parser, freeze_parse_result, ParsingException
+import pyparsing as pp
+
+corpus = (
+    "price gt 100",
+    "price gt 100 AND city.name eq 'tehran'",
+    "status eq 'active' and is_deleted eq false",
+    "tolower(title) eq 'carpentry' OR price lt 3 AND price gt 1",
+    "(price gt 1 OR price lt 0) AND id eq 2",
+    "((a eq 1) OR (b eq 2)) AND c eq 3 AND d eq 4",
+    "substringof('یوسف', name) eq true",
+    "startswith(slug, 'teh') eq true AND endswith(slug, 'ran') eq true",
+    "year(created_at) eq 2021 AND month(created_at) ge 3",
+    "created_at ge 2021-01-05 AND created_at lt 2021-2-1",
+    "created_at ge '2021-01-05' OR updated_at eq null",
+    "id in [1,2,3]",
+    "city_id in [ 10,20]",
+    "tags has 'urgent' AND tags lacks 'draft'",
+    "price add 10 gt 200",
+    "rate eq .5",
+    "name eq 'it\\'s'",
+    "province.country.name eq 'iran' AND city.name ne 'karaj' Or city.slug eq 'qom'",
+    "length(title) gt 3",
+    "f() eq 1",
+    "true AND false",
+    "a eq 1 AND",
+    "a eq 1 AND (b eq 2",
+    "price gt100",
+    "x eq 2021-01-05T10:00",
+)
+
+invalid = (
+    "",
+    "AND a eq 1",
+    "created_at lt NOW",
+    "id in [1,2, 3 ]",
+    "(a eq 1",
+    "title eq",
+)
+
+
+def pyparsing_parse(text):
+    return freeze_parse_result(filter_grammar.parseString(text).asList())
+
+
+for item in corpus:
+    expected = pyparsing_parse(item)
+    actual = fast_filter_parser.parse(item)
+    assert expected == actual, f'{item!r}: {expected} != {actual}'
+
+for item in invalid:
+    try:
+        pyparsing_parse(item)
+        raise AssertionError(f'{item!r} must be rejected by pyparsing')
+    except pp.ParseException:
+        pass
+    try:
+        fast_filter_parser.parse(item)
+        raise AssertionError(f'{item!r} must be rejected by parser')
+    except ParsingException:
+        pass
+
+print(f'{len(corpus) + len(invalid)} filters conform')
+
+clause = "(substringof('ab', tolower(title)) eq true OR year(created_at) eq 2021)"
+for clauses in (1, 10, 50):
+    text = ' AND '.join(clause.replace('tolower(title)', 'title') if i % 2 else f"city.name eq 'c{i}'"
+                        for i in range(clauses))
+    number = 200 if clauses < 50 else 20
+    slow = timeit.timeit(lambda: pyparsing_parse(text), number=number) / number
+    fast = timeit.timeit(lambda: fast_filter_parser.parse(text), number=number) / number
+    print(f'{clauses:>2} clauses: pyparsing {slow * 1000:.3f} ms, parser {fast * 1000:.3f} ms, {slow / fast:.1f}x')
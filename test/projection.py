@@ -0,0 +1,57 @@
+import timeit
+import tracemalloc
+
+from sqlalchemy import Column, Integer, String, ForeignKey, create_engine
+from sqlalchemy.orm import declarative_base, relationship, Session
+
+from catalyst.adapters import ODataQueryAdapter
+from catalyst.extensions import to_dict
+
+Base = declarative_base()
+width = 40
+rows = 20000
+
+
+class City(Base):
+    __tablename__ = 'city'
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+
+
+class Wide(Base):
+    __tablename__ = 'wide'
+    id = Column(Integer, primary_key=True)
+    city_id = Column(ForeignKey('city.id'))
+    city = relationship(City)
+    locals().update({f'column_{i}': Column(String) for i in range(width)})
+
+
+engine = create_engine('sqlite://')
+Base.metadata.create_all(engine)
+session = Session(engine)
+session.add_all(City(id=i, name=f'city {i}') for i in range(1, 11))
+session.execute(Wide.__table__.insert(), [dict({f'column_{i}': f'value {i} of {n}' for i in range(width)},
+                                               id=n, city_id=n % 10 + 1) for n in range(1, rows + 1)])
+session.commit()
+
+query = f'$select=id,column_0,column_1&$expand=city($select=name)&$top={rows}'
+
+
+def search(use_projection: bool):
+    adapter = ODataQueryAdapter(Wide)
+    adapter.use_projection = use_projection
+    adapter.parse(uri=query)
+    result = to_dict(adapter.create_func(session)(), depth=4)
+    session.expunge_all()
+    return result
+
+
+assert search(False) == search(True), 'Projection must serialize the same as ORM entities'
+
+for use_projection in (False, True):
+    elapsed = timeit.timeit(lambda: search(use_projection), number=3) / 3
+    tracemalloc.start()
+    search(use_projection)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{"projection" if use_projection else "entities":>10}: {elapsed * 1000:.0f} ms, peak {peak / 2 ** 20:.1f} MiB')
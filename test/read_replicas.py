@@ -0,0 +1,77 @@
+import os
+import tempfile
+
+from flask import Flask
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.orm import declarative_base, Session
+
+import catalyst
+
+app = Flask(__name__)
+catalyst.register_application(app, None)
+
+from catalyst import data_abstraction
+from catalyst.data_abstraction import search_using_OData, get_by_slug, init_read_replicas, ReplicaPolicy
+
+Base = declarative_base()
+
+
+class City(Base):
+    __tablename__ = 'city'
+    id = Column(Integer, primary_key=True)
+    slug = Column(String)
+    name = Column(String)
+
+
+directory = tempfile.mkdtemp()
+primary, *replicas = engines = [create_engine(f'sqlite:///{os.path.join(directory, name)}.db')
+                                for name in ('primary', 'replica_1', 'replica_2')]
+for engine in engines:
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(City(id=1, slug='tehran', name=os.path.basename(engine.url.database)))
+        session.commit()
+
+lags = dict.fromkeys(replicas, 0.0)
+init_read_replicas(*replicas, lag_query=lambda connection: lags[connection.engine])
+router = data_abstraction.replica_router
+router.lag_check_interval = 0
+
+session = Session(primary)
+
+
+def search() -> str:
+    items, _ = search_using_OData(session, '$top=1', City, use_replica=True)
+    return items[0].name
+
+
+with app.app_context():
+    assert [search() for _ in range(4)] == ['replica_1.db', 'replica_2.db'] * 2, 'Replicas must be used in turn'
+    assert search_using_OData(session, '$top=1', City)[0][0].name == 'primary.db', 'Routing must be requested'
+    assert get_by_slug(City, session, 'tehran', use_replica=True).name.startswith('replica')
+
+    lags[replicas[0]] = router.max_lag + 1
+    assert {search() for _ in range(4)} == {'replica_2.db'}, 'Lagging replicas must be skipped'
+    lags[replicas[1]] = router.max_lag + 1
+    assert search() == 'primary.db', 'Primary must be used if all replicas lag'
+    lags.update(dict.fromkeys(replicas, 0.0))
+
+    router.policy = ReplicaPolicy.LeastConnections
+    connection = replicas[0].connect()
+    assert {search() for _ in range(4)} == {'replica_2.db'}, 'Replica with fewer connections must be used'
+    connection.close()
+
+    session.add(City(id=2, slug='shiraz', name='primary.db'))
+    assert get_by_slug(City, session, 'shiraz', use_replica=True) is not None, 'Pending writes must be read'
+    session.flush()
+    assert search() == 'primary.db', 'Flushed writes must be read from primary'
+    session.rollback()
+    assert search().startswith('replica'), 'Rolled back writes must not pin the session'
+
+    session.add(City(id=2, slug='shiraz', name='primary.db'))
+    session.commit()
+    assert get_by_slug(City, session, 'shiraz', use_replica=True) is not None, 'Committed writes must be read'
+    router.max_lag = 0
+    assert search().startswith('replica'), 'Session must be routed again once replicas caught up'
+
+print('Read replica routing works')
@@ -0,0 +1,64 @@
+import datetime
+
+from sqlalchemy import Column, Integer, String, DateTime, create_engine
+from sqlalchemy.orm import declarative_base, Session
+
+from catalyst.adapters import ODataQueryAdapter, PrefixMatch, rewrite_sargable, fast_filter_parser
+
+Base = declarative_base()
+
+
+class Order(Base):
+    __tablename__ = 'orders'
+    id = Column(Integer, primary_key=True)
+    title = Column(String)
+    created_at = Column(DateTime)
+
+
+engine = create_engine('sqlite://')
+Base.metadata.create_all(engine)
+session = Session(engine)
+session.add_all(Order(id=i, title=title, created_at=datetime.datetime(2020 + i % 3, 1 + i % 12, 1))
+                for i, title in enumerate(('1%off', '1_x', '12 a', 'Abc', 'abd', 'ABE', '-a', '%', 'x\\y'), 1))
+session.commit()
+
+corpus = (
+    ("startswith(title, '1') eq true", True),
+    ("startswith(title, '1%') eq true", True),
+    ("startswith(title, '1_') eq true", True),
+    ("startswith(title, '%') eq true", True),
+    ("startswith(title, '-') ne false", True),
+    ("startswith(title, 'ab') eq true", False),
+    ("startswith(title, 'x\\y') eq true", False),
+    ("startswith(tolower(title), 'ab') eq true", True),
+    ("startswith(toupper(title), 'AB') eq true", True),
+    ("startswith(tolower(title), 'AB') eq true", False),
+    ("year(created_at) eq 2021", False),
+    ("year(created_at) ge 2021 AND startswith(title, '1') eq true", True),
+)
+
+
+def search(text: str, use_sargable_rewrite: bool):
+    adapter = ODataQueryAdapter(Order)
+    adapter.use_fast_parser = True
+    adapter.use_sargable_rewrite = use_sargable_rewrite
+    adapter.parse(uri=f'$filter={text}&$orderby=id')
+    return [o.id for o in adapter.create_query(session)]
+
+
+def has_prefix_match(node) -> bool:
+    return isinstance(node, PrefixMatch) or isinstance(node, tuple) and any(map(has_prefix_match, node))
+
+
+for text, rewritten in corpus:
+    assert has_prefix_match(rewrite_sargable(fast_filter_parser.parse(text))) == rewritten, \
+        f'{text!r} must{"" if rewritten else " not"} be rewritten to a prefix match'
+    if '%' not in text and '_' not in text:
+        expected, actual = search(text, False), search(text, True)
+        assert expected == actual, f'{text!r}: {expected} != {actual}'
+
+assert search("startswith(title, '1%') eq true", True) == [1], 'LIKE wildcards of the prefix must be escaped'
+assert search("startswith(title, '1_') eq true", True) == [2], 'LIKE wildcards of the prefix must be escaped'
+assert search("startswith(title, '%') eq true", True) == [8], 'LIKE wildcards of the prefix must be escaped'
+
+print('Rewritten predicates match the original ones')
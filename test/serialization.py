@@ -0,0 +1,200 @@
+import collections
+import re
+import timeit
+from dataclasses import dataclass, asdict, is_dataclass
+from datetime import datetime, date, time, timedelta
+from decimal import Decimal
+from enum import Enum
+from typing import Optional, List, Iterable, Union, Dict, Any, TypeVar, get_type_hints
+from uuid import UUID, uuid4
+
+import rapidjson
+from inflector import Inflector
+from khayyam import JalaliDatetime, JalaliDate
+from pytz import country_timezones, timezone
+from shapely.geometry import mapping
+from shapely.geometry.base import BaseGeometry
+
+from catalyst.constants import RegExPatterns, DEFAULT_LOCALE, DEFAULT_TIMEZONE
+from catalyst.extensions import to_dict, SerializationFlags
+
+T = TypeVar('T')
+items = 1000
+
+
+class Status(Enum):
+    Active = 'active'
+    Archived = 'archived'
+
+
+@dataclass
+class AddressDTO:
+    cityName: str
+    postalCode: Optional[str] = None
+
+
+@dataclass
+class ProductDTO:
+    id: UUID
+    title: str
+    price: Decimal
+    status: Status
+    createdAt: datetime
+    releaseDate: date
+    description: Optional[str] = None
+    address: Optional[AddressDTO] = None
+    tags: Optional[List[str]] = None
+
+
+def reference_to_dict(obj: T, *,
+                      flags: SerializationFlags = SerializationFlags(''),
+                      locale: str = DEFAULT_LOCALE,
+                      depth: int = 3,
+                      uuid_hex: bool = True,
+                      inflection: bool = False,
+                      datetime_formatter: Optional[str] = None) -> Union[T, Dict[str, Any],
+                                                                         Iterable[Dict[str, Any]], None]:
+    """
+    to_dict as it was before the serialization plans, for comparison
+    """
+
+    inflector = Inflector()
+    if obj is None:
+        if flags.ReplaceNoneWithEmptyString:
+            return ''
+        else:
+            return
+
+    if depth == 0:
+        return
+
+    m = re.match(RegExPatterns.Locale, locale)
+    t = type(obj)
+    if m:
+        locale = m.group()
+    else:
+        locale = DEFAULT_LOCALE
+
+    if is_dataclass(obj):
+        annotations = get_type_hints(type(obj))
+        res = asdict(obj)
+
+        return {inflector.underscore(k) if inflection else k: reference_to_dict(res[k], flags=flags,
+                                                                                locale=locale,
+                                                                                depth=depth,
+                                                                                inflection=inflection,
+                                                                                datetime_formatter=datetime_formatter)
+                for k in res
+                if res[k] is not None
+                or flags.IncludeNulls
+                or (flags.ReplaceNoneWithEmptyString and annotations[k]) == str}
+    elif issubclass(t, BaseGeometry):
+        return mapping(obj)
+    elif any(issubclass(t, parent) for parent in (int, str, bytes, float, bool)):
+        return obj
+    elif issubclass(t, Enum):
+        return obj.value
+    elif t is Decimal:
+        return float(obj)
+    elif t is UUID:
+        if uuid_hex:
+            return obj.hex
+        else:
+            return obj
+    elif t in (datetime, date, time):
+        country: str = locale[-2:]
+        if country in country_timezones:
+            tz = timezone(country_timezones[country][0])
+        else:
+            tz = timezone(DEFAULT_TIMEZONE)
+        if locale.startswith('fa-'):
+            if t is datetime:
+                if flags.IgnoreLocaleCalendar:
+                    if flags.IgnoreLocaleTimeZone:
+                        return obj.isoformat()
+                    if obj.tzinfo is None:
+                        return tz.fromutc(obj).isoformat()
+                    else:
+                        return obj.astimezone(tz)
+                else:
+                    if datetime_formatter:
+                        formatter = lambda d: '{{:{}}}'.format(datetime_formatter).format(d)
+                    else:
+                        formatter = JalaliDatetime.isoformat
+
+                    if flags.IgnoreLocaleTimeZone:
+                        return formatter(JalaliDatetime(obj))
+                    if obj.tzinfo is None:
+                        return formatter(JalaliDatetime(tz.fromutc(obj)))
+                    else:
+                        return formatter(JalaliDatetime(obj.astimezone(tz)))
+            elif t is date:
+                if flags.IgnoreLocaleCalendar:
+                    return obj.isoformat()
+                else:
+                    return JalaliDate(obj).isoformat()
+            elif t is time:
+                return obj.isoformat()
+        else:
+            return obj.isoformat()
+    elif isinstance(obj, timedelta):
+        return re.sub(r'(?<=[^1-9])0[YMDHS]', '',
+                      'P{year}Y{month}M{day}DT{hour}H{minute}M{second}S'
+                      .format(year=obj.days // 365,
+                              month=(obj.days % 365) // 30,
+                              day=obj.days % 30,
+                              hour=obj.seconds // 3600,
+                              minute=(obj.seconds % 3600) // 60,
+                              second=obj.seconds % 60))
+
+    elif isinstance(obj, collections.Mapping):
+        return {inflector.underscore(k) if inflection else k: reference_to_dict(obj[k],
+                                                                                flags=flags,
+                                                                                locale=locale,
+                                                                                depth=depth - 1,
+                                                                                inflection=inflection,
+                                                                                datetime_formatter=datetime_formatter)
+                for k in obj
+                if obj[k] is not None
+                or flags.IncludeNulls}
+
+    elif isinstance(obj, Iterable) or isinstance(obj, collections.Sequence):
+
+        gen = (reference_to_dict(item,
+                                 flags=flags,
+                                 locale=locale,
+                                 depth=depth - 1,
+                                 inflection=inflection,
+                                 datetime_formatter=datetime_formatter)
+               for item in obj
+               if item is not None
+               or flags.IncludeNulls)
+
+        return t(gen) if isinstance(obj, collections.Sequence) else tuple(gen)
+    else:
+        return {attr: reference_to_dict(getattr(obj, attr),
+                                        flags=flags,
+                                        locale=locale,
+                                        depth=depth - 1,
+                                        inflection=inflection,
+                                        datetime_formatter=datetime_formatter)
+                for attr in vars(obj) if not attr.startswith('_')}
+
+
+products = [ProductDTO(id=uuid4(), title=f'product {n}', price=Decimal(n) / 100, status=tuple(Status)[n % 2],
+                       createdAt=datetime(2021, 1, 1) + timedelta(minutes=n),
+                       releaseDate=date(2021, 1, 1) + timedelta(days=n),
+                       description=None if n % 3 else f'description {n}',
+                       address=AddressDTO(cityName='tehran', postalCode=None if n % 2 else str(n)),
+                       tags=['new', 'sale'][:n % 3])
+            for n in range(items)]
+
+for flags, locale, inflection in ((SerializationFlags(''), 'fa-IR', False),
+                                  (SerializationFlags('IncludeNulls,IgnoreLocaleCalendar'), 'en-US', True)):
+    options = dict(flags=flags, locale=locale, depth=5, inflection=inflection)
+    assert rapidjson.dumps(to_dict(products, **options)) == rapidjson.dumps(reference_to_dict(products, **options)), \
+        'Serialization plans must convert the same as the reference'
+    reference = timeit.timeit(lambda: reference_to_dict(products, **options), number=5) / 5
+    planned = timeit.timeit(lambda: to_dict(products, **options), number=5) / 5
+    print(f'{locale}, inflection={inflection}: reference {reference * 1000:.0f} ms, '
+          f'plan {planned * 1000:.0f} ms, {reference / planned:.1f}x')
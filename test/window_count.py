@@ -0,0 +1,49 @@
+from flask import Flask
+from sqlalchemy import Column, Integer, String, ForeignKey, create_engine
+from sqlalchemy.orm import declarative_base, relationship, Session
+
+import catalyst
+
+app = Flask(__name__)
+catalyst.register_application(app, None)
+
+from catalyst.data_abstraction import search_using_OData
+
+Base = declarative_base()
+
+
+class Order(Base):
+    __tablename__ = 'orders'
+    id = Column(Integer, primary_key=True)
+    title = Column(String)
+    items = relationship('Item')
+
+
+class Item(Base):
+    __tablename__ = 'item'
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    order_id = Column(ForeignKey('orders.id'))
+
+
+engine = create_engine('sqlite://')
+Base.metadata.create_all(engine)
+session = Session(engine)
+session.add_all(Order(id=i, title=f'order {i}', items=[Item(name=f'item {i} {j}') for j in range(3)])
+                for i in range(1, 7))
+session.commit()
+
+queries = (
+    '$top=2&$count=true',
+    "$top=2&$count=true&$filter=title ne 'zz'",
+    "$top=2&$count=true&$filter=items.name ne 'zz'",
+)
+
+with app.app_context():
+    for query in queries:
+        separate = search_using_OData(session, query, Order)
+        window = search_using_OData(session, query, Order, use_window_count=True)
+        assert [o.id for o in separate[0]] == [o.id for o in window[0]], f'{query!r}: pages differ'
+        assert separate[1] == window[1] == 6, f'{query!r}: {separate[1]} != {window[1]}'
+
+print('Window count matches the separate count query')